@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import time
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pymysql
 import tormysql
 import tornado.gen
+import tornado.ioloop
+
+from constants import logger, ExecutorBusyError
 
 #
 # Pool of connections to the database.
@@ -16,6 +24,30 @@ pool = None
 #
 connect_db_args = {}
 #
+# List of arguments for connections to the read replicas. Each
+# element is a full dictionary like connect_db_args.
+#
+replica_db_args = []
+#
+# Pools of the replicas. @sa class Replica.
+#
+replicas = []
+#
+# Index of the replica for the next read. Replicas are used
+# round-robin.
+#
+next_replica = 0
+#
+# Periodic health check of the replicas.
+#
+replica_checker = None
+#
+# Count of seconds after a write of a user, during which the reads of
+# this user are executed on the primary, so the user sees own changes
+# even if the replicas are behind.
+#
+read_your_writes_seconds = 0
+#
 # Global tornado application server.
 #
 app = None
@@ -29,10 +61,364 @@ template_path = ''
 static_path = ''
 login_url = ''
 
+#
+# Executor for CPU-bound parsing of the uploaded reports, so the
+# IOLoop is not blocked while a report is being parsed.
+# @sa BoundedExecutor.
+#
+parse_executor = None
+#
+# Executor for password hashing. PBKDF2 takes tens of milliseconds,
+# so a burst of logins would block the IOLoop.
+# @sa BoundedExecutor.
+#
+hash_executor = None
+
+##
+# Errors, meaning that a database server is not available.
+#
+connection_errors = (pymysql.err.OperationalError,
+		     pymysql.err.InterfaceError,
+		     tormysql.WaitConnectionTimeoutError,
+		     tornado.gen.TimeoutError, OSError)
+
+##
+# Pool of connections to a read replica together with its state.
+#
+class Replica:
+	def __init__(self, args):
+		self.host = args.get('host')
+		self.pool = tormysql.helpers.ConnectionPool(**args)
+		#
+		# Unhealthy replica is not used until the next
+		# successful health check.
+		#
+		self.healthy = True
+		#
+		# Data version, seen on the replica by the last health
+		# check. None - unknown.
+		#
+		self.version = None
+
 def connect_db():
 	global pool
+	global replicas
 	pool = tormysql.helpers.ConnectionPool(**connect_db_args)
+	replicas = [Replica(args) for args in replica_db_args]
 
 def begin():
 	assert(pool)
 	return pool.begin()
+
+##
+# Executor of read-only queries with the interface of a transaction,
+# so the functions from query.py can be used without a transaction.
+# The connections of the pool are in the autocommit mode, so no BEGIN
+# and COMMIT are sent, and the connection is returned to the pool
+# right after the query. Each query takes its own connection.
+# Consecutive queries are not isolated from concurrent changes, so it
+# must not be used for the queries which depend on each other's
+# consistency.
+#
+class Reader:
+	@tornado.gen.coroutine
+	def execute(self, query, params=None):
+		assert(pool)
+		cursor = yield pool.execute(query, params)
+		return cursor
+
+reader = Reader()
+
+##
+# Get the next healthy replica round-robin.
+# @param min_version Minimal data version, which the replica must
+#                    have. None - any.
+# @retval     None No suitable replicas.
+# @retval not None Replica.
+#
+def get_replica(min_version=None):
+	global next_replica
+	for i in range(len(replicas)):
+		replica = replicas[(next_replica + i) % len(replicas)]
+		if min_version is not None and \
+		   (replica.version is None or replica.version < min_version):
+			continue
+		if replica.healthy:
+			next_replica = (next_replica + i + 1) % len(replicas)
+			return replica
+	return None
+
+##
+# Executor of read-only queries on the replicas. It has the same
+# interface as Reader. If there are no healthy replicas, or the chosen
+# one fails, then the query is executed on the primary. The data on a
+# replica can be behind the primary, so it must not be used for
+# filling the caches and right after a write of the same user.
+# @sa BaseHandler.get_analytics_reader().
+#
+class ReplicaReader:
+	##
+	# @param min_version Minimal data version of the used replicas.
+	#                    While all the replicas are behind it, the
+	#                    queries are executed on the primary. None -
+	#                    any replica is used.
+	#
+	def __init__(self, min_version=None):
+		self.min_version = min_version
+
+	@tornado.gen.coroutine
+	def execute(self, query, params=None):
+		replica = get_replica(self.min_version)
+		if replica is not None:
+			try:
+				cursor = yield replica.pool.execute(query,
+								    params)
+				return cursor
+			except connection_errors:
+				logger.exception('Replica {} is not available'\
+						 .format(replica.host))
+				replica.healthy = False
+		cursor = yield reader.execute(query, params)
+		return cursor
+
+##
+# Check all the replicas and update their health and data versions.
+# @param timeout Timeout of the check of one replica in seconds.
+#
+@tornado.gen.coroutine
+def check_replicas(timeout):
+	for replica in list(replicas):
+		try:
+			cursor = yield tornado.gen.with_timeout(
+				timedelta(seconds=timeout),
+				replica.pool.execute('SELECT version FROM '\
+						     'data_version'))
+			row = cursor.fetchone()
+			replica.version = row[0] if row else 0
+			if not replica.healthy:
+				logger.info('Replica {} is available again'\
+					    .format(replica.host))
+			replica.healthy = True
+		except Exception:
+			if replica.healthy:
+				logger.exception('Replica {} check failed'\
+						 .format(replica.host))
+			replica.healthy = False
+
+##
+# Start periodic health checks of the replicas.
+# @param interval Interval between checks in seconds.
+#
+def start_replica_checks(interval):
+	global replica_checker
+	if not replicas:
+		return
+	replica_checker = tornado.ioloop.PeriodicCallback(
+		lambda: check_replicas(interval), interval * 1000)
+	replica_checker.start()
+
+##
+# Run independent read-only queries concurrently. Each query is
+# executed by the reader on its own connection from the pool, so the
+# total time is determined by the slowest query instead of the sum of
+# all of them.
+# @param funcs Coroutine functions with the single argument - the
+#              executor of queries. @sa Reader.
+#
+# @retval List of results of the funcs in the same order.
+#
+@tornado.gen.coroutine
+def run_parallel(*funcs):
+	results = yield tornado.gen.multi([func(reader) for func in funcs])
+	return results
+
+##
+# Call func(*args) and return the result together with the time,
+# which the job waited in the executor queue.
+# @param submitted Time of the job submission, time.time().
+#
+# @retval Tuple (wait time in seconds, result of the func).
+#
+def call_measured(submitted, func, *args):
+	wait = time.time() - submitted
+	return (wait, func(*args))
+
+##
+# Interval in seconds of checking, whether a queued job of the
+# BoundedExecutor with a timeout has started.
+#
+QUEUE_POLL_INTERVAL = 0.1
+
+##
+# Pool of processes or threads for CPU-bound jobs with a limit of the
+# submitted jobs and statistics of the time, which jobs wait in the
+# queue. A job occupies its place in the limit until it is really
+# finished, even if the waiting for it was interrupted by the
+# timeout, so abandoned jobs can not overfill the pool.
+#
+class BoundedExecutor:
+	##
+	# @param name          Name of the executor for logs.
+	# @param workers       Count of worker processes or threads.
+	# @param use_processes If true, then try to use the process
+	#                      pool and fallback to the thread pool on
+	#                      failure.
+	# @param queue_size    Maximal count of submitted jobs - running
+	#                      and waiting. Jobs above this limit are
+	#                      rejected.
+	# @param timeout       Timeout of one job in seconds, counted
+	#                      from the start of the job. It covers
+	#                      only the running job - the time in the
+	#                      queue is bounded by queue_size. None - no
+	#                      timeout.
+	#
+	def __init__(self, name, workers, use_processes, queue_size,
+		     timeout=None):
+		self.name = name
+		self.executor = None
+		if use_processes:
+			try:
+				self.executor = ProcessPoolExecutor(
+					max_workers=workers)
+			except Exception:
+				logger.exception('Can not create a process '\
+						 'pool, use threads for {}'\
+						 .format(name))
+		if not self.executor:
+			self.executor = ThreadPoolExecutor(max_workers=workers)
+		self.queue_size = queue_size
+		self.timeout = timeout
+		#
+		# Count of jobs, submitted and not finished yet.
+		#
+		self.jobs = 0
+		#
+		# Statistics of the time in seconds, which finished jobs
+		# waited in the queue before the start.
+		#
+		self.wait_count = 0
+		self.wait_total = 0
+		self.wait_max = 0
+
+	##
+	# Get the average time in seconds, which jobs wait in the
+	# queue.
+	#
+	def get_average_wait(self):
+		if self.wait_count == 0:
+			return 0
+		return self.wait_total / self.wait_count
+
+	##
+	# Execute func(*args) in the executor and wait for the result
+	# without blocking the IOLoop. The func and the args must be
+	# picklable, if the process pool is used.
+	# @retval Result of the func.
+	#
+	# @exception ExecutorBusyError Too many jobs are in progress.
+	# @exception tornado.gen.TimeoutError The job was not finished
+	#            in timeout seconds after its start. The job is not
+	#            stopped and keeps its place until it finishes.
+	#
+	@tornado.gen.coroutine
+	def run(self, func, *args):
+		if self.jobs >= self.queue_size:
+			logger.warning('Executor {} is busy: {} jobs, average '\
+				       'wait {:.3f}s'.format(self.name, self.jobs,
+							    self.get_average_wait()))
+			raise ExecutorBusyError()
+		self.jobs += 1
+		try:
+			future = self.executor.submit(call_measured,
+						      time.time(), func, *args)
+		except:
+			self.jobs -= 1
+			raise
+		tornado.ioloop.IOLoop.current().add_future(future,
+							   self.job_done)
+		wait, result = yield self.wait_job(future)
+		self.wait_count += 1
+		self.wait_total += wait
+		self.wait_max = max(self.wait_max, wait)
+		return result
+
+	##
+	# Release the place of the finished job. Called in the
+	# IOLoop.
+	#
+	def job_done(self, future):
+		self.jobs -= 1
+
+	##
+	# Wait for the job result. The timeout is counted from the
+	# start of the job, so the time in the queue is not included.
+	# @param future concurrent.futures.Future of the job.
+	#
+	# @exception tornado.gen.TimeoutError The job was not finished
+	#            in timeout seconds after the start.
+	#
+	@tornado.gen.coroutine
+	def wait_job(self, future):
+		if self.timeout is None:
+			result = yield future
+			return result
+		started = None
+		while True:
+			if started is None and (future.running() or
+						future.done()):
+				started = time.time()
+			if started is None:
+				timeout = QUEUE_POLL_INTERVAL
+			else:
+				timeout = max(started + self.timeout - time.time(),
+					      0)
+			try:
+				result = yield tornado.gen.with_timeout(
+					timedelta(seconds=timeout), future)
+				return result
+			except tornado.gen.TimeoutError:
+				if started is not None:
+					raise
+
+##
+# Create the executor for parsing the reports.
+# @param workers       Count of worker processes or threads.
+# @param use_processes If true, then try to use the process pool and
+#                      fallback to the thread pool on failure.
+# @param queue_size    Maximal count of submitted parse jobs.
+# @param timeout       Timeout of one parse job in seconds.
+#
+def start_parse_executor(workers, use_processes, queue_size, timeout):
+	global parse_executor
+	parse_executor = BoundedExecutor('parse', workers, use_processes,
+					 queue_size, timeout)
+
+##
+# Parse in the parse executor. @sa BoundedExecutor.run().
+#
+@tornado.gen.coroutine
+def run_parse(func, *args):
+	assert(parse_executor)
+	result = yield parse_executor.run(func, *args)
+	return result
+
+##
+# Create the executor for hashing the passwords.
+# @param workers       Count of worker processes or threads.
+# @param use_processes If true, then try to use the process pool and
+#                      fallback to the thread pool on failure.
+# @param queue_size    Maximal count of submitted hashing jobs.
+#
+def start_hash_executor(workers, use_processes, queue_size):
+	global hash_executor
+	hash_executor = BoundedExecutor('hash', workers, use_processes,
+					queue_size)
+
+##
+# Hash in the hash executor. @sa BoundedExecutor.run().
+#
+@tornado.gen.coroutine
+def run_hash(func, *args):
+	assert(hash_executor)
+	result = yield hash_executor.run(func, *args)
+	return result
@@ -2,12 +2,69 @@
 # -*- coding: utf-8 -*-
 
 import json
+import time
+import hashlib
 
 import tornado
 import tornado.web
+import tornado.gen
 
+import cache
+import application
+from query import get_user_by_id
 from constants import *
 
+##
+# Name of the cookie with the session token.
+#
+SESSION_COOKIE = 'session'
+
+##
+# Lifetime of the session in days.
+#
+SESSION_DAYS = 1
+
+##
+# Encode the session token value. The value is
+# 'user_id:version:rights:issued:user_name', where issued is the time
+# of the token creation. The user name is the last, because it can
+# contain ':'.
+# @param session Dictionary with 'user_id', 'version', 'rights',
+#                'issued' and 'user_name'.
+#
+def encode_session(session):
+	user_name = session['user_name']
+	if not user_name:
+		user_name = ''
+	return '{}:{}:{}:{}:{}'.format(session['user_id'], session['version'],
+				       session['rights'], session['issued'],
+				       user_name)
+
+##
+# Decode the session token value.
+# @param value Value of the verified session cookie, bytes.
+#
+# @retval     None The value is incorrect.
+# @retval not None Dictionary as in encode_session().
+#
+def decode_session(value):
+	if not value:
+		return None
+	try:
+		fields = value.decode('utf-8').split(':', 4)
+		if len(fields) != 5:
+			return None
+		session = { 'user_id': int(fields[0]),
+			    'version': int(fields[1]),
+			    'rights': int(fields[2]),
+			    'issued': int(fields[3]),
+			    'user_name': fields[4] }
+	except ValueError:
+		return None
+	if not session['user_name']:
+		session['user_name'] = None
+	return session
+
 ##
 # Base class for users authentication and error pages rendering.
 #
@@ -19,24 +76,177 @@ class BaseHandler(tornado.web.RequestHandler):
 		return super(BaseHandler, self).render(*args, **kwargs,
 						       **rights_dictionary)
 	##
-	# User cookies are: user_id, rights. This methods return user_id.
+	# Authenticate the user by the session token. The user is
+	# loaded from the database only if his current version is not
+	# known to this process: after the process start or after a
+	# change of the user. An outdated token is reissued with the
+	# current rights, and the token of a deleted user is removed.
+	#
+	@tornado.gen.coroutine
+	def prepare(self):
+		session = self.get_session()
+		if session is None:
+			self.current_user = None
+			return
+		user_id = session['user_id']
+		if cache.sessions.has_user(user_id):
+			user = cache.sessions.get_user(user_id)
+		else:
+			version = cache.sessions.version
+			try:
+				user = yield self.load_user(application.reader,
+							    user_id)
+			except Exception:
+				logger.exception('Error with loading the user '\
+						 'of the session')
+				self.render_error(e_hdr=ERR_500)
+				return
+			cache.sessions.put_user(user_id, user, version)
+		if user is None:
+			self.clear_cookie(SESSION_COOKIE)
+			self.current_user = None
+		elif user['version'] != session['version']:
+			self.set_session(user)
+		else:
+			self.current_user = dict(user)
+
+	##
+	# Get the current user without access to the database. Used
+	# only if the user is requested before prepare().
 	#
 	def get_current_user(self):
-		user_id = self.get_secure_cookie('user_id', None)
-		if not user_id:
+		session = self.get_session()
+		if session is None:
 			return None
-		user = {'user_id': int(user_id)}
-		user['rights'] = int(self.get_secure_cookie('rights'))
-		user['user_name'] = self.get_secure_cookie('user_name', None)
-		if user['user_name']:
-			user['user_name'] = user['user_name'].decode('utf-8')
-		return user
+		user = cache.sessions.get_user(session['user_id'])
+		if user is None or user['version'] != session['version']:
+			return None
+		return dict(user)
+
+	##
+	# Get the session of the request. The signature of the token is
+	# checked only if the token is not in the session cache.
+	#
+	# @retval     None No session or it is incorrect or expired.
+	# @retval not None Dictionary as in encode_session(). It is
+	#                  shared between requests and must not be
+	#                  modified.
+	#
+	def get_session(self):
+		token = self.get_cookie(SESSION_COOKIE, None)
+		if not token:
+			return None
+		session = cache.sessions.get_token(token)
+		if session is None:
+			value = self.get_secure_cookie(SESSION_COOKIE, value=token,
+						       max_age_days=SESSION_DAYS)
+			session = decode_session(value)
+			if session is None:
+				return None
+			cache.sessions.put_token(token, session)
+		if session['issued'] + SESSION_DAYS * 24 * 3600 < time.time():
+			return None
+		return session
+
+	##
+	# Load the user data for the session.
+	# @param tx      Current transaction or application.reader.
+	# @param user_id Identifier of the user.
+	#
+	# @retval     None The user is not found.
+	# @retval not None Dictionary with 'user_id', 'version',
+	#                  'rights' and 'user_name'.
+	#
+	@tornado.gen.coroutine
+	def load_user(self, tx, user_id):
+		columns = [ 'id', 'version', 'rights', 'name' ]
+		user = yield get_user_by_id(tx, columns, user_id)
+		if not user:
+			return None
+		return { 'user_id': user['id'], 'version': user['version'],
+			 'rights': user['rights'], 'user_name': user['name'] }
 	
+	##
+	# Set the validators of the response and check them against
+	# the conditional request headers. The ETag is built from the
+	# data version, the request URI and the current user, so pages
+	# differing by rights have different tags. The data version is
+	# the last change read from the database, so all the server
+	# processes issue the same validators. Must be called before
+	# any access to the database. The validators are removed, if an
+	# error is rendered then. Reports of past years can be uploaded
+	# late or corrected, so the browser must revalidate any
+	# response.
+	#
+	# @retval true  The data was not modified. The response status
+	#               is set to 304, and the handler must return
+	#               without writing anything.
+	# @retval false The response must be built as usual.
+	#
+	def check_not_modified(self):
+		if cache.changes.version is None:
+			return False
+		user = self.current_user
+		tag = '{}:{}:{}:{}:{}'.format(cache.changes.version,
+					      user['user_id'], user['rights'],
+					      user['user_name'],
+					      self.request.uri)
+		etag = '"{}"'.format(hashlib.md5(tag.encode('utf-8'))\
+				     .hexdigest())
+		self.set_header('Etag', etag)
+		if cache.changes.modified is not None:
+			self.set_header('Last-Modified', cache.changes.modified)
+		self.set_header('Cache-Control', 'private, no-cache')
+		if self.check_etag_header():
+			self.set_status(304)
+			return True
+		return False
+
+	##
+	# Remove the validators, set by check_not_modified(), so an
+	# error response is not cached.
+	#
+	def clear_validators(self):
+		self.clear_header('Etag')
+		self.clear_header('Last-Modified')
+		self.clear_header('Cache-Control')
+
+	##
+	# Remember that the user has changed the data. During
+	# application.read_your_writes_seconds after that the reads
+	# of the user are not sent to the replicas.
+	#
+	def mark_written(self):
+		if not application.replicas:
+			return
+		until = int(time.time()) + application.read_your_writes_seconds
+		self.set_cookie('primary_until', str(until))
+
+	##
+	# Get the executor for heavy read-only queries, which results
+	# are not cached: replicas, if the user has not changed the
+	# data recently, and the primary otherwise. Only the replicas,
+	# which have read the data version of the validators, are used.
+	# Else the response of a lagging replica is tagged by the new
+	# version and is confirmed by 304 after the replica catches up.
+	# @sa application.ReplicaReader, check_not_modified().
+	#
+	def get_analytics_reader(self):
+		until = self.get_cookie('primary_until', None)
+		if until is not None:
+			try:
+				if int(until) > time.time():
+					return application.reader
+			except ValueError:
+				pass
+		return application.ReplicaReader(cache.changes.version)
+
 	##
 	# Render an error page with specified an error header and a message.
 	#
 	def render_error(self, e_hdr, e_msg=None, template='error_page.html',
 			 **kwargs):
+		self.clear_validators()
 		if e_msg == None:
 			if e_hdr in ERR_MESSAGES:
 				e_msg = ERR_MESSAGES[e_hdr]
@@ -52,11 +262,42 @@ class BaseHandler(tornado.web.RequestHandler):
 	def render_json(self, data):
 		self.write(json.dumps({ 'response': data }))
 
+	##
+	# Render series in the JSON format, requested by the user. If
+	# the 'max_points' argument is specified, then each series is
+	# downsampled to this count of points and is encoded with the
+	# explicit days, so the gaps between the kept points are not
+	# sent.
+	# @param tree  Dictionary with series.
+	# @param depth Count of nesting levels above the series.
+	#              @sa encode_series_tree().
+	#
+	def render_series_json(self, tree, depth):
+		format = self.get_argument('format', SERIES_FORMAT_DICT)
+		if format not in series_formats:
+			format = SERIES_FORMAT_DICT
+		max_points = self.get_argument('max_points', None)
+		if max_points is not None:
+			try:
+				max_points = int(max_points)
+				if max_points < MIN_DOWNSAMPLE_POINTS:
+					raise ValueError('Too few points')
+			except ValueError:
+				self.render_json_error('Количество точек должно '\
+						       'быть целым числом не '\
+						       'меньше {}'.format(
+						       MIN_DOWNSAMPLE_POINTS))
+				return
+			tree = downsample_series_tree(tree, depth, max_points)
+		self.render_json(encode_series_tree(tree, depth, format,
+						    max_points is not None))
+
 	##
 	# Render the error information in the JSON format with the
 	# specified error message.
 	#
 	def render_json_error(self, msg):
+		self.clear_validators()
 		self.write(json.dumps({ 'error': msg }))
 
 	##
@@ -93,27 +334,197 @@ class BaseHandler(tornado.web.RequestHandler):
 		return True
 
 	##
-	# Reset the cookies of the current user. If a user_name
-	# cookie is None, then it is deleted.
-	# @param rights    Rights mask.
-	# @param user_name Name of the user.
+	# Issue a new session token for the user and make him the
+	# current user.
+	# @param user Dictionary with 'user_id', 'version', 'rights'
+	#             and 'user_name'.
 	#
-	def update_cookies(self, rights, user_name):
+	def set_session(self, user):
+		assert(user['rights'])
+		session = dict(user)
+		session['issued'] = int(time.time())
+		token = self.create_signed_value(SESSION_COOKIE,
+						 encode_session(session))
+		self.set_cookie(SESSION_COOKIE, token, expires_days=SESSION_DAYS)
+		cache.sessions.put_token(token.decode('utf-8'), session)
+		self.current_user = dict(user)
+
+##
+# Formats of the series in JSON responses of the plot endpoints. The
+# format is chosen by the 'format' request argument.
+# SERIES_FORMAT_DICT  - default, { day: value }, days without value are
+#                       absent.
+# SERIES_FORMAT_DENSE - { 'start': first day, 'values': [...] }, where
+#                       values[i] is the value on the day start + i or
+#                       null.
+# SERIES_FORMAT_DELTA - { 'start': first day, 'scale': scale,
+#                       'deltas': [...] }, where deltas are integer
+#                       differences between value * scale and the
+#                       previous not null value * scale. Gaps are null.
+#                       If the values can not be scaled to integers,
+#                       then SERIES_FORMAT_DENSE is used.
+# The sparse variants of the dense and the delta formats have the list
+# 'days' of the days with a value instead of 'start', and the values
+# or the deltas only for these days, without nulls.
+#
+SERIES_FORMAT_DICT = 'dict'
+SERIES_FORMAT_DENSE = 'dense'
+SERIES_FORMAT_DELTA = 'delta'
+series_formats = [ SERIES_FORMAT_DICT, SERIES_FORMAT_DENSE,
+		   SERIES_FORMAT_DELTA ]
+
+##
+# Maximal power of 10, by which values are scaled for the delta
+# encoding.
+#
+MAX_DELTA_SCALE_POWER = 3
+
+##
+# Get the smallest power of 10, which turns all the values into
+# integers.
+# @retval not None Scale.
+# @retval     None Values have too many digits after the point.
+#
+def get_delta_scale(values):
+	for power in range(MAX_DELTA_SCALE_POWER + 1):
+		scale = 10 ** power
+		for val in values:
+			scaled = val * scale
+			if abs(scaled - round(scaled)) > 1e-6:
+				break
+		else:
+			return scale
+	return None
+
+##
+# Encode the series in the specified format.
+# @param days   Dictionary { day: value }.
+# @param format One of series_formats.
+# @param sparse Use the sparse variant of the format.
+#
+def encode_series(days, format, sparse=False):
+	if format == SERIES_FORMAT_DICT:
+		return days
+	present = sorted([day for day, val in days.items()
+			  if val is not None])
+	if sparse:
+		res = { 'days': present }
+		values = [days[day] for day in present]
+	elif not present:
+		return { 'start': 1, 'values': [] }
+	else:
+		start = present[0]
+		res = { 'start': start }
+		values = [None] * (present[-1] - start + 1)
+		for day in present:
+			values[day - start] = days[day]
+	if format == SERIES_FORMAT_DELTA:
+		scale = get_delta_scale([days[day] for day in present])
+		if scale is not None:
+			deltas = []
+			prev = 0
+			for val in values:
+				if val is None:
+					deltas.append(None)
+					continue
+				val = int(round(val * scale))
+				deltas.append(val - prev)
+				prev = val
+			res['scale'] = scale
+			res['deltas'] = deltas
+			return res
+	res['values'] = values
+	return res
+
+##
+# Minimal count of points, to which a series can be downsampled: the
+# first, the last and at least one between them.
+#
+MIN_DOWNSAMPLE_POINTS = 3
+
+##
+# Reduce the series to max_points points by the Largest Triangle
+# Three Buckets algorithm. It keeps the first and the last points
+# and from each bucket between them chooses the point, which forms
+# the largest triangle with the point chosen from the previous
+# bucket and the average of the next bucket. So peaks and the shape
+# of the plot are preserved.
+# @param days       Dictionary { day: value }.
+# @param max_points Maximal count of points in the result, at least
+#                   MIN_DOWNSAMPLE_POINTS.
+#
+# @retval Dictionary { day: value } with no more than max_points
+#         days. Days without value are removed.
+#
+def downsample_series(days, max_points):
+	assert(max_points >= MIN_DOWNSAMPLE_POINTS)
+	points = sorted([(day, val) for day, val in days.items()
+			 if val is not None])
+	count = len(points)
+	if count <= max_points:
+		return dict(points)
+	sampled = [points[0]]
+	bucket_size = (count - 2) / (max_points - 2)
+	prev = points[0]
+	for i in range(max_points - 2):
 		#
-		# Rights specifies which actions the user can
-		# execute.
+		# Average point of the next bucket.
 		#
-		assert(rights)
-		self.set_secure_cookie('rights', str(rights), expires_days=1)
-		if not user_name:
-			self.clear_cookie('user_name')
-		else:
-			self.set_secure_cookie('user_name', user_name,
-					       expires_days=1)
-		if self.current_user:
-			self.current_user['rights'] = rights
-			if user_name:
-				self.current_user['user_name'] = user_name
+		next_start = int((i + 1) * bucket_size) + 1
+		next_end = min(int((i + 2) * bucket_size) + 1, count)
+		next_bucket = points[next_start:next_end]
+		avg_x = sum([p[0] for p in next_bucket]) / len(next_bucket)
+		avg_y = sum([p[1] for p in next_bucket]) / len(next_bucket)
+		#
+		# Point of the current bucket with the largest
+		# triangle area.
+		#
+		start = int(i * bucket_size) + 1
+		end = int((i + 1) * bucket_size) + 1
+		best = None
+		best_area = -1
+		for point in points[start:end]:
+			area = abs((prev[0] - avg_x) * (point[1] - prev[1]) -
+				   (prev[0] - point[0]) * (avg_y - prev[1]))
+			if area > best_area:
+				best_area = area
+				best = point
+		sampled.append(best)
+		prev = best
+	sampled.append(points[-1])
+	return dict(sampled)
+
+##
+# Downsample all series in the tree of nested dictionaries.
+# @sa encode_series_tree(), downsample_series().
+#
+def downsample_series_tree(tree, depth, max_points):
+	if depth == 0:
+		return downsample_series(tree, max_points)
+	res = {}
+	for key, subtree in tree.items():
+		res[key] = downsample_series_tree(subtree, depth - 1,
+						  max_points)
+	return res
+
+##
+# Encode all series in the tree of nested dictionaries.
+# @param tree   Dictionary with series on the depth level.
+# @param depth  Count of nesting levels above the series. For example,
+#               { boiler: { parameter: series } } has depth 2.
+# @param format One of series_formats.
+# @param sparse Use the sparse variant of the format.
+#
+def encode_series_tree(tree, depth, format, sparse=False):
+	if format == SERIES_FORMAT_DICT:
+		return tree
+	if depth == 0:
+		return encode_series(tree, format, sparse)
+	res = {}
+	for key, subtree in tree.items():
+		res[key] = encode_series_tree(subtree, depth - 1, format,
+					      sparse)
+	return res
 
 ##
 # Decorator to check rights mask.
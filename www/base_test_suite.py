@@ -13,6 +13,7 @@ from tornado.httpclient import AsyncHTTPClient, HTTPError
 
 import secret_conf
 import application
+from base_handler import SESSION_COOKIE, decode_session
 from constants import *
 
 test_users = [
@@ -236,16 +237,13 @@ class BaseTestSuite(tornado.testing.AsyncHTTPTestCase):
 			return { 'error': 'Failed to login',
 				 'response': response }
 		#
-		# Parse cookies.
+		# Parse the session cookie.
 		#
-		user_id = None
-		user_name = None
-		rights = None
-
-		user_id = int(decode_cookie(response, 'user_id', 1))
-		user_name = decode_cookie(response, 'user_name', 1)
-		user_name = user_name.decode('utf-8')
-		rights = int(decode_cookie(response, 'rights', 1))
+		session = decode_session(decode_cookie(response,
+						       SESSION_COOKIE, 1))
+		user_id = session['user_id']
+		user_name = session['user_name']
+		rights = session['rights']
 		#
 		# Follow the redirect url.
 		#
@@ -0,0 +1,769 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import math
+from array import array
+from collections import OrderedDict
+
+import tornado
+import tornado.gen
+import tornado.ioloop
+
+from query import *
+from constants import logger
+
+##
+# In-memory cache of the districts and the boiler rooms. These tables
+# are changed only when an uploaded report contains a new district or
+# a boiler room, so they are loaded from the database once and are
+# reloaded only after invalidate().
+# Each invalidation increments the version. A loader stores its result
+# only if the version was not changed during the load, so data, loaded
+# concurrently with an upload, is never cached.
+# The cached objects are shared between requests and must not be
+# modified.
+#
+class DimensionCache:
+	def __init__(self):
+		self.version = 0
+		self.district_ids = None
+		self.room_ids = None
+		self.boilers = None
+		self.districts = None
+
+	##
+	# Drop all cached data. Must be called after a transaction,
+	# which inserted new districts or boiler rooms, is committed.
+	#
+	def invalidate(self):
+		self.version += 1
+		self.district_ids = None
+		self.room_ids = None
+		self.boilers = None
+		self.districts = None
+
+	##
+	# @sa CacheRegistry.
+	#
+	def on_data_change(self, date, exists, new_dimensions):
+		if new_dimensions:
+			self.invalidate()
+
+	def clear(self):
+		self.invalidate()
+
+	##
+	# Get identifiers of all districts and boiler rooms.
+	# @param tx Current transaction or application.reader.
+	#
+	# @retval Tuple (district ids, room ids). @sa get_district_ids(),
+	#         get_boiler_room_ids().
+	#
+	@tornado.gen.coroutine
+	def get_ids(self, tx):
+		if self.district_ids is not None:
+			return (self.district_ids, self.room_ids)
+		version = self.version
+		district_ids = yield get_district_ids(tx)
+		room_ids = yield get_boiler_room_ids(tx)
+		if version == self.version:
+			self.district_ids = district_ids
+			self.room_ids = room_ids
+		return (district_ids, room_ids)
+
+	##
+	# Cached get_boiler_room_ids_and_titles().
+	#
+	@tornado.gen.coroutine
+	def get_boiler_room_ids_and_titles(self, tx):
+		if self.boilers is not None:
+			return self.boilers
+		version = self.version
+		boilers = yield get_boiler_room_ids_and_titles(tx)
+		if version == self.version:
+			self.boilers = boilers
+		return boilers
+
+	##
+	# Cached get_districts_with_boilers().
+	#
+	@tornado.gen.coroutine
+	def get_districts_with_boilers(self, tx):
+		if self.districts is not None:
+			return self.districts
+		version = self.version
+		districts = yield get_districts_with_boilers(tx)
+		if version == self.version:
+			self.districts = districts
+		return districts
+
+##
+# Count of elements in a year series - days in a leap year.
+#
+YEAR_SERIES_LEN = 366
+
+##
+# Convert a year series into the dictionary of the
+# get_boiler_year_report() format: { day: value }. Days are numbered
+# from 1, missing days are skipped.
+#
+def get_series_days(series):
+	res = {}
+	for i, val in enumerate(series):
+		if not math.isnan(val):
+			res[i + 1] = val
+	return res
+
+##
+# In-memory columnar store of the boiler room parameters along a
+# year. For each boiler room and year it holds a float array of
+# YEAR_SERIES_LEN elements per parameter: i-th element is the value on
+# (i + 1)-th day of the year, or NaN, if the value is unknown.
+# Parameters are loaded lazily, only when they are requested. An
+# upload or a deletion of a report drops all series of its year.
+# Only boiler rooms, which have reports in the year, are cached, and
+# the least recently used ones are evicted above max_size, so
+# requests of arbitrary identifiers and years can not grow the cache.
+#
+class YearSeriesCache:
+	##
+	# @param max_size Maximal count of cached pairs (boiler id,
+	#                 year).
+	#
+	def __init__(self, max_size=1024):
+		assert(max_size > 0)
+		self.max_size = max_size
+		#
+		# { (boiler id, year): { parameter: array } }, the last
+		# is the most recently used.
+		#
+		self.series = OrderedDict()
+		#
+		# { year: version } of the invalidated years and the
+		# version of the whole cache. @sa DimensionCache.
+		#
+		self.versions = {}
+		self.version = 0
+
+	##
+	# Drop all series of the year. Must be called after a
+	# transaction, which changed reports of the year, is
+	# committed.
+	#
+	def invalidate_year(self, year):
+		self.versions[year] = self.versions.get(year, 0) + 1
+		for key in [key for key in self.series if key[1] == year]:
+			del self.series[key]
+
+	##
+	# @sa CacheRegistry.
+	#
+	def on_data_change(self, date, exists, new_dimensions):
+		self.invalidate_year(date.year)
+
+	def clear(self):
+		self.version += 1
+		self.series.clear()
+
+	##
+	# Get the version of the year series. @sa DimensionCache.
+	#
+	def get_version(self, year):
+		return (self.version, self.versions.get(year, 0))
+
+	##
+	# Get series of the boiler room from the cache without
+	# access to the database.
+	# @param boiler_id Identifier of the boiler room.
+	# @param year      Year of the series.
+	# @param cols      List of parameters.
+	#
+	# @retval     None Some of the parameters are not cached.
+	# @retval not None Dictionary { parameter: array }.
+	#
+	# @exception AccessError One of the parameters is not a
+	#            column of boiler_room_reports.
+	#
+	def get(self, boiler_id, year, cols):
+		for col in cols:
+			if col not in boiler_room_report_cols:
+				raise AccessError('[{}]'.format(','.join(cols)))
+		key = (int(boiler_id), int(year))
+		columns = self.series.get(key)
+		if not columns:
+			return None
+		self.series.move_to_end(key)
+		res = {}
+		for col in cols:
+			if col not in columns:
+				return None
+			res[col] = columns[col]
+		return res
+
+	##
+	# Get series of the boiler room, loading the missing ones from
+	# the database.
+	# @param tx Current transaction or application.reader.
+	# @sa get().
+	#
+	@tornado.gen.coroutine
+	def load(self, tx, boiler_id, year, cols):
+		res = self.get(boiler_id, year, cols)
+		if res is not None:
+			return res
+		boiler_id = int(boiler_id)
+		res = yield self.load_many(tx, year, { boiler_id: cols })
+		return res[boiler_id]
+
+	##
+	# Get series of several boiler rooms. All missing series are
+	# loaded from the database by one query.
+	# @param tx       Current transaction or application.reader.
+	# @param year     Year of the series.
+	# @param requests Dictionary { boiler id: list of parameters }.
+	#
+	# @retval Dictionary { boiler id: { parameter: array } }.
+	#
+	@tornado.gen.coroutine
+	def load_many(self, tx, year, requests):
+		year = int(year)
+		res = {}
+		missing_ids = []
+		missing_cols = set()
+		for boiler_id, cols in requests.items():
+			boiler_id = int(boiler_id)
+			series = self.get(boiler_id, year, cols)
+			if series is not None:
+				res[boiler_id] = series
+				continue
+			missing_ids.append(boiler_id)
+			missing_cols.update(cols)
+		if not missing_ids:
+			return res
+		missing_cols = sorted(missing_cols)
+		version = self.get_version(year)
+		report = yield get_boilers_year_report(tx, missing_ids, year,
+						       missing_cols)
+		for boiler_id, columns in report.items():
+			loaded = {}
+			exists = False
+			for col, days in columns.items():
+				values = array('d', [math.nan]) * YEAR_SERIES_LEN
+				for day, val in days.items():
+					exists = True
+					if val is not None:
+						values[day - 1] = val
+				loaded[col] = values
+			res[boiler_id] = loaded
+			#
+			# Absent boiler rooms and years have no
+			# reports and are not cached.
+			#
+			if exists and version == self.get_version(year):
+				self.put(boiler_id, year, loaded)
+		return res
+
+	##
+	# Store the loaded series and evict the least recently used
+	# ones above max_size.
+	#
+	def put(self, boiler_id, year, loaded):
+		key = (boiler_id, year)
+		if key not in self.series:
+			self.series[key] = {}
+		self.series[key].update(loaded)
+		self.series.move_to_end(key)
+		while len(self.series) > self.max_size:
+			self.series.popitem(last=False)
+
+##
+# LRU cache of the daily reports, prepared for showing, keyed by the
+# report date. Past reports are almost never changed, so the cache
+# saves the database queries on each opening of a report. An upload or
+# a deletion of a report evicts its date.
+#
+class ReportCache:
+	##
+	# @param max_size Maximal count of cached reports.
+	#
+	def __init__(self, max_size=64):
+		assert(max_size > 0)
+		self.max_size = max_size
+		#
+		# { date: report }, the last is the most recently used.
+		#
+		self.reports = OrderedDict()
+		#
+		# @sa DimensionCache.
+		#
+		self.version = 0
+
+	##
+	# Evict the report on the specified date. Must be called after
+	# a transaction, which changed the report, is committed.
+	# @param date Date of the report, datetime.date.
+	#
+	def invalidate(self, date):
+		self.version += 1
+		self.reports.pop(date, None)
+
+	##
+	# @sa CacheRegistry.
+	#
+	def on_data_change(self, date, exists, new_dimensions):
+		self.invalidate(date)
+
+	def clear(self):
+		self.version += 1
+		self.reports.clear()
+
+	##
+	# Get the report from the cache.
+	# @param date Date of the report, datetime.date.
+	#
+	# @retval     None The report is not cached.
+	# @retval not None The report. It is shared between requests
+	#                  and must not be modified.
+	#
+	def get(self, date):
+		report = self.reports.get(date)
+		if report is not None:
+			self.reports.move_to_end(date)
+		return report
+
+	##
+	# Store the loaded report in the cache.
+	# @param date    Date of the report, datetime.date.
+	# @param report  The report.
+	# @param version Value of the version before the report
+	#                loading. If the cache was invalidated since
+	#                then, the report is not stored.
+	#
+	def put(self, date, report, version):
+		if version != self.version:
+			return
+		self.reports[date] = report
+		self.reports.move_to_end(date)
+		if len(self.reports) > self.max_size:
+			self.reports.popitem(last=False)
+
+##
+# Get the number of the bit of the date in a year bitmap of
+# ReportDatesCache.
+# @param date datetime.date.
+#
+def get_date_bit(date):
+	return date.timetuple().tm_yday - 1
+
+##
+# Encode a year bitmap of ReportDatesCache into a hex string of
+# YEAR_SERIES_LEN / 4 digits. k-th digit holds bits from 4 * k to
+# 4 * k + 3, the lowest bit of the digit is the earliest day.
+#
+def encode_date_bitmap(bitmap):
+	digits = (YEAR_SERIES_LEN + 3) // 4
+	return ''.join(['{:x}'.format((bitmap >> (4 * k)) & 0xf)
+			for k in range(digits)])
+
+##
+# In-memory cache of the report dates. For each year it holds a bitmap
+# of YEAR_SERIES_LEN bits: i-th bit is set, if there is a report on the
+# (i + 1)-th day of the year. Bitmaps are updated by an upload or a
+# deletion of a report, so they are loaded from the database only once
+# per year.
+#
+class ReportDatesCache:
+	def __init__(self):
+		#
+		# { year: bitmap }
+		#
+		self.bitmaps = {}
+		#
+		# { year: version }. @sa DimensionCache.
+		#
+		self.versions = {}
+
+	##
+	# Set or clear the bit of the date. Must be called after a
+	# transaction, which inserted or deleted the report, is
+	# committed.
+	# @param date   Date of the report, datetime.date.
+	# @param exists True, if the report was inserted.
+	#
+	def update(self, date, exists):
+		year = date.year
+		self.versions[year] = self.versions.get(year, 0) + 1
+		if year not in self.bitmaps:
+			return
+		bit = 1 << get_date_bit(date)
+		if exists:
+			self.bitmaps[year] |= bit
+		else:
+			self.bitmaps[year] &= ~bit
+
+	##
+	# @sa CacheRegistry.
+	#
+	def on_data_change(self, date, exists, new_dimensions):
+		self.update(date, exists)
+
+	def clear(self):
+		for year in list(self.versions):
+			self.versions[year] += 1
+		self.bitmaps = {}
+
+	##
+	# Get bitmaps of several years. All missing years are loaded
+	# from the database by one query. Only the years with reports
+	# are cached, so requests of arbitrary years do not fill the
+	# cache.
+	# @param tx    Current transaction or application.reader. Can
+	#              be None, if all the years are cached.
+	# @param years List of years.
+	#
+	# @retval Dictionary { year: bitmap }.
+	#
+	@tornado.gen.coroutine
+	def load_many(self, tx, years):
+		res = {}
+		missing = []
+		for year in years:
+			year = int(year)
+			if year in self.bitmaps:
+				res[year] = self.bitmaps[year]
+			else:
+				missing.append(year)
+		if not missing:
+			return res
+		versions = {year: self.versions.get(year, 0)
+			    for year in missing}
+		start = get_year_range(min(missing))[0]
+		end = get_year_range(max(missing))[1]
+		dates = yield get_report_dates_by_range(tx, start, end)
+		loaded = {year: 0 for year in missing}
+		for date in dates:
+			if date.year in loaded:
+				loaded[date.year] |= 1 << get_date_bit(date)
+		for year, bitmap in loaded.items():
+			if bitmap and \
+			   versions[year] == self.versions.get(year, 0):
+				self.bitmaps[year] = bitmap
+			res[year] = bitmap
+		return res
+
+	##
+	# Get the bitmap of the year.
+	# @sa load_many().
+	#
+	@tornado.gen.coroutine
+	def load(self, tx, year):
+		res = yield self.load_many(tx, [year])
+		return res[int(year)]
+
+##
+# Cache of the user sessions. Keeps two mappings:
+# - LRU of the recently verified session tokens, so the signature of
+#   a token is checked only once while it stays in the cache;
+# - the current version, rights and name of the users, who have sent
+#   a token to this process. A token with another version is
+#   outdated and is reissued with the current rights.
+# A change of a user evicts his data from both mappings. So the next
+# request of the user loads him from the database once.
+#
+class SessionCache:
+	##
+	# @param max_size Maximal count of cached tokens.
+	#
+	def __init__(self, max_size=1024):
+		assert(max_size > 0)
+		self.max_size = max_size
+		#
+		# { token: user }, the last is the most recently used.
+		#
+		self.tokens = OrderedDict()
+		#
+		# { user_id: user }. The user is None, if he was
+		# deleted.
+		#
+		self.users = {}
+		#
+		# @sa DimensionCache.
+		#
+		self.version = 0
+
+	##
+	# Evict the user. Must be called after a transaction, which
+	# changed or deleted the user, is committed.
+	# @param user_id Identifier of the user.
+	#
+	def invalidate(self, user_id):
+		self.version += 1
+		self.users.pop(user_id, None)
+		tokens = [token for token, user in self.tokens.items()
+			  if user['user_id'] == user_id]
+		for token in tokens:
+			del self.tokens[token]
+
+	def clear(self):
+		self.version += 1
+		self.tokens.clear()
+		self.users.clear()
+
+	##
+	# Get the user of the verified token.
+	# @param token Value of the session cookie.
+	#
+	# @retval     None The token was not verified yet.
+	# @retval not None Dictionary with the decoded token. It is
+	#                  shared between requests and must not be
+	#                  modified.
+	#
+	def get_token(self, token):
+		user = self.tokens.get(token)
+		if user is not None:
+			self.tokens.move_to_end(token)
+		return user
+
+	##
+	# Store the verified token.
+	# @param token Value of the session cookie.
+	# @param user  Dictionary with the decoded token.
+	#
+	def put_token(self, token, user):
+		self.tokens[token] = user
+		self.tokens.move_to_end(token)
+		if len(self.tokens) > self.max_size:
+			self.tokens.popitem(last=False)
+
+	##
+	# Check, that the current user data is known.
+	# @param user_id Identifier of the user.
+	#
+	def has_user(self, user_id):
+		return user_id in self.users
+
+	##
+	# Get the current user data.
+	# @param user_id Identifier of the user.
+	#
+	# @retval     None The user is deleted or not known.
+	#                  @sa has_user().
+	# @retval not None Dictionary with 'user_id', 'version',
+	#                  'rights' and 'user_name'.
+	#
+	def get_user(self, user_id):
+		return self.users.get(user_id)
+
+	##
+	# Store the current user data, loaded from the database.
+	# @param user_id Identifier of the user.
+	# @param user    Dictionary as in get_user() or None, if the
+	#                user is not found.
+	# @param version Value of the version before the user
+	#                loading. If the cache was invalidated since
+	#                then, the user is not stored.
+	#
+	def put_user(self, user_id, user, version):
+		if version != self.version:
+			return
+		self.users[user_id] = user
+
+##
+# Registry of all caches, which depend on the reports data. A cache
+# must implement two methods:
+# on_data_change(date, exists, new_dimensions) - drop or update the
+#     data, which depends on the report on the date. exists is true,
+#     if the report was inserted, and false, if it was deleted.
+#     new_dimensions is true, if new districts or boiler rooms were
+#     inserted;
+# clear() - drop all the data.
+#
+class CacheRegistry:
+	def __init__(self):
+		self.caches = []
+
+	##
+	# Add the cache to the registry.
+	# @retval The cache.
+	#
+	def register(self, cache):
+		self.caches.append(cache)
+		return cache
+
+	def data_changed(self, date, exists, new_dimensions):
+		for cache in self.caches:
+			cache.on_data_change(date, exists, new_dimensions)
+
+	def clear(self):
+		for cache in self.caches:
+			cache.clear()
+
+##
+# Keeper of the caches coherent with changes, made by other server
+# processes. Each change of the reports data is registered in the
+# database by insert_data_change() in the same transaction. The
+# tracker periodically reads the changes, made after the last seen
+# version, and passes them to the registry. Changes of the users are
+# registered by insert_user_change() and are passed to the session
+# cache. So the caches of all the processes are updated with a delay
+# not greater than the poll interval.
+#
+class ChangeTracker:
+	def __init__(self, registry, sessions):
+		self.registry = registry
+		self.sessions = sessions
+		#
+		# Last seen version. None - the tracker is not
+		# initialized, and changes are not read. It is the same
+		# in all the processes, which have read the same
+		# changes, so it is used to build HTTP validators.
+		#
+		self.version = None
+		#
+		# Time of the last seen change, UTC, or None, if it is
+		# unknown.
+		#
+		self.modified = None
+		#
+		# Versions of the changes made by this process and
+		# already passed to the registry.
+		#
+		self.own_versions = set()
+		self.polling = False
+		self.poller = None
+
+	##
+	# Read the current version. Must be called before the server
+	# starts to fill the caches.
+	# @param tx Current transaction or application.reader.
+	#
+	@tornado.gen.coroutine
+	def init(self, tx):
+		self.version, self.modified = yield get_data_version(tx)
+
+	##
+	# Pass the change, made by this process, to the registry. Must
+	# be called after the transaction, which made the change, is
+	# committed.
+	# @param version Version of the change from
+	#                insert_data_change().
+	# @sa CacheRegistry.on_data_change().
+	#
+	def data_changed(self, version, date, exists, new_dimensions):
+		self.registry.data_changed(date, exists, new_dimensions)
+		self.add_own_version(version)
+
+	##
+	# Pass the change of the user, made by this process, to the
+	# session cache. Must be called after the transaction, which
+	# made the change, is committed.
+	# @param version Version of the change from
+	#                insert_user_change().
+	# @param user_id Identifier of the user.
+	#
+	def user_changed(self, version, user_id):
+		self.sessions.invalidate(user_id)
+		self.add_own_version(version)
+
+	def add_own_version(self, version):
+		if self.version is None or version <= self.version:
+			return
+		self.own_versions.add(version)
+		#
+		# Move to the own changes at once, if there are no
+		# unread changes before them, so the validators change
+		# together with the caches of this process. The time
+		# of the change is known after the poll.
+		#
+		while self.version + 1 in self.own_versions:
+			self.version += 1
+			self.modified = None
+
+	##
+	# Read new changes and pass them to the registry. If some of
+	# the changes are lost, for example, they were deleted from
+	# the database before this process read them, then all the
+	# caches are cleared.
+	# @param tx Current transaction or application.reader.
+	#
+	@tornado.gen.coroutine
+	def poll(self, tx):
+		if self.version is None or self.polling:
+			return
+		self.polling = True
+		try:
+			#
+			# The version can be moved by own changes during
+			# the read.
+			#
+			last = self.version
+			changes = yield get_data_changes(tx, last)
+			if not changes:
+				return
+			if changes[0][0] != last + 1:
+				logger.warning('Data changes from {} to {} are '\
+					       'lost, clear all caches'\
+					       .format(last + 1,
+						       changes[0][0] - 1))
+				self.registry.clear()
+				self.sessions.clear()
+			else:
+				for version, date, exists, new_dims, user_id, \
+				    _ in changes:
+					if version in self.own_versions:
+						continue
+					if user_id is not None:
+						self.sessions.invalidate(user_id)
+						continue
+					self.registry.data_changed(date,
+								   bool(exists),
+								   bool(new_dims))
+			if changes[-1][0] >= self.version:
+				self.version = changes[-1][0]
+				self.modified = changes[-1][5]
+			self.own_versions = set([version for version in
+						 self.own_versions
+						 if version > self.version])
+		except Exception:
+			logger.exception('Error with reading data changes')
+		finally:
+			self.polling = False
+
+	##
+	# Start periodic reading of the changes.
+	# @param tx       Current transaction or application.reader.
+	# @param interval Interval between reads in seconds.
+	#
+	def start(self, tx, interval):
+		self.poller = tornado.ioloop.PeriodicCallback(
+			lambda: self.poll(tx), interval * 1000)
+		self.poller.start()
+
+#
+# Registry of all the global caches.
+#
+registry = CacheRegistry()
+#
+# Global cache of the districts and the boiler rooms.
+#
+dimensions = registry.register(DimensionCache())
+#
+# Global cache of the boiler rooms parameters along years.
+#
+year_series = registry.register(YearSeriesCache())
+#
+# Global cache of the daily reports.
+#
+reports = registry.register(ReportCache())
+#
+# Global cache of the report dates.
+#
+report_dates = registry.register(ReportDatesCache())
+#
+# Global cache of the user sessions.
+#
+sessions = SessionCache()
+#
+# Tracker of the data changes, made by other processes.
+#
+changes = ChangeTracker(registry, sessions)
@@ -58,9 +58,28 @@ wind_directions = {
 }
 
 date_format = '%d.%m.%Y'
+#
+# Format of dates in the database and in links to reports.
+#
+db_date_format = '%Y-%m-%d'
+#
+# Maximal count of series in one request of the plot series.
+#
+max_series_count = 200
 
 class AccessError(Exception):
 	def __init__(self, access_to_what):
 		message = 'Доступ к ресурсам {} '\
 			  'запрещен'.format(access_to_what)
 		super(AccessError, self).__init__(message)
+
+class NameCollisionError(Exception):
+	def __init__(self, name):
+		message = 'Название "{}" совпадает по первым символам с '\
+			  'названием из базы данных'.format(name)
+		super(NameCollisionError, self).__init__(message)
+
+class ExecutorBusyError(Exception):
+	def __init__(self):
+		super(ExecutorBusyError, self).__init__('Очередь задач '\
+							'переполнена')
@@ -5,14 +5,19 @@ import sys
 import argparse
 import logging
 import unittest
+from datetime import datetime
 
 import tornado
 import tornado.ioloop
 import tornado.web
 import tornado.gen
+import tornado.netutil
+import tornado.process
+import tornado.httpserver
 
 import secret_conf
 import application
+import cache
 from base_handler         import BaseHandler, need_rights
 from upload_handler       import UploadHandler
 from show_handler         import ShowHandler
@@ -23,10 +28,6 @@ from users_management     import UsersManagementHandler
 from query import *
 from constants import *
 
-from tests_prepare_suite     import AAA_TestSuitePrepare
-from test_login_logout_suite import TestSuiteLoginLogout
-from test_users_management   import TestSuiteUsersManagement
-
 ##
 # Main page render.
 #
@@ -65,44 +66,55 @@ class LoginHandler(BaseHandler):
 			self.render_error(e_hdr=ERR_LOGIN,
 					  e_msg='Не указан пароль')
 			return
-		tx = None
 		try:
-			tx = yield application.begin()
 			#
-			# Try to find the user by specified email.
+			# Try to find the user by specified email. The
+			# login only reads, so no transaction is held
+			# while the password is hashed.
 			#
 			columns = [ 'id', 'password', 'salt', 'rights', 'name',
-				    'email' ]
-			user = yield get_user_by_email(tx, columns, email)
+				    'email', 'version' ]
+			cache_version = cache.sessions.version
+			user = yield get_user_by_email(application.reader,
+						       columns, email)
 			if not user:
-				self.rollback_error(tx, e_hdr=ERR_404,
-						    e_msg='Пользователь с '\
-						    	  'таким email не '\
-						    	  'зарегистрирован')
+				self.render_error(e_hdr=ERR_404,
+						  e_msg='Пользователь с таким '\
+							'email не '\
+							'зарегистрирован')
 				return
 			true_password = user['password']
 			salt = user['salt']
 			#
 			# Check that the password is correct.
 			#
-			if not secret_conf.check_password(password, salt,
-							  true_password):
-				self.rollback_error(tx, e_hdr=ERR_ACCESS,
-						    e_msg='Неправильный пароль')
+			is_correct = yield secret_conf.check_password_async(
+				password, salt, true_password)
+			if not is_correct:
+				self.render_error(e_hdr=ERR_ACCESS,
+						  e_msg='Неправильный пароль')
 				return
-			user_id = user['id']
-			rights = user['rights']
-			user_name = user['name']
 			#
-			# Set cookies for the current user for one day.
+			# Start the session. The user data is already
+			# loaded, so remember it to not load on the
+			# next request.
 			#
-			self.set_secure_cookie('user_id', str(user_id),
-					       expires_days=1)
-			self.update_cookies(rights, user_name)
-			yield tx.commit()
+			session_user = { 'user_id': user['id'],
+					 'version': user['version'],
+					 'rights': user['rights'],
+					 'user_name': user['name'] }
+			cache.sessions.put_user(user['id'], session_user,
+						cache_version)
+			self.set_session(session_user)
+		except ExecutorBusyError:
+			logger.error('Too many passwords are being checked')
+			self.render_error(e_hdr=ERR_500,
+					  e_msg='Сервер занят, повторите '\
+						'попытку позже')
+			return
 		except Exception as e:
 			logger.exception('Error during login')
-			self.rollback_error(tx, e_hdr=ERR_500)
+			self.render_error(e_hdr=ERR_500)
 			return
 		self.redirect('/')
 ##
@@ -125,11 +137,22 @@ class DropHandler(BaseHandler):
 			self.render_error(e_hdr=ERR_404,
 					  e_msg='Не указана дата отчета')
 			return
+		try:
+			date = datetime.strptime(date, db_date_format).date()
+		except ValueError:
+			self.render_error(e_hdr=ERR_PARAMETERS,
+					  e_msg='Неверный формат даты отчета')
+			return
 		tx = None
 		try:
 			tx = yield application.begin()
 			yield delete_report_by_date(tx, date)
-			tx.commit()
+			yield update_rollups(tx, date)
+			version = yield insert_data_change(tx, date, False,
+							   False)
+			yield tx.commit()
+			cache.changes.data_changed(version, date, False, False)
+			self.mark_written()
 		except Exception:
 			logger.exception("Error with deleting report by date")
 			self.rollback_error(tx, e_hdr=ERR_500)
@@ -165,32 +188,35 @@ class GetYearParameterHandler(BaseHandler):
 		if year is None:
 			self.render_json_error('Не указан год')
 			return
-		tx = None
 		try:
-			tx = yield application.begin()
-			columns = [ param_name, 'T1', 'T2' ]
-			report = yield get_boiler_year_report(tx, boiler_id,
-							      year, columns)
-			self.render_json(report)
-			tx.commit()
+			year = int(year)
+		except ValueError:
+			self.render_json_error('Неверный год')
+			return
+		if self.check_not_modified():
+			return
+		columns = [ param_name, 'T1', 'T2' ]
+		try:
+			#
+			# Most of requests are served by the cache
+			# without a database access.
+			#
+			series = yield cache.year_series.load(application.reader,
+							      boiler_id, year,
+							      columns)
 		except AccessError as e:
 			logger.exception('AccessError with getting parameters')
-			if not tx:
-				logger.exception('Strange error - no '\
-						 'transaction')
-				self.render_json_error('На сервере произошла '\
-						       'ошибка, обратитесь к '\
-						       'администратору')
-			else:
-				self.render_json_error('Ошибка доступа: ' +
-						       str(e))
+			self.render_json_error('Ошибка доступа: ' + str(e))
+			return
 		except:
 			logger.exception('Error with getting parameter')
-			if tx:
-				tx.rollback()
 			self.render_json_error('На сервере произошла ошибка, '\
 					       'обратитесь к администратору')
 			return
+		report = {}
+		for col, values in series.items():
+			report[col] = cache.get_series_days(values)
+		self.render_series_json(report, 1)
 
 ##
 # Get values of the specified parameter from all boilers along the
@@ -239,20 +265,262 @@ class GetMonthParameterHandler(BaseHandler):
 						       'столбец {}'.format(col))
 				return
 			columns.append(col)
-		tx = None
 		try:
-			tx = yield application.begin()
-			boilers = yield get_boilers_month_values(tx, year,
-								 month, columns)
-			self.render_json(boilers)
-			tx.commit()
+			year = int(year)
+		except ValueError:
+			self.render_json_error('Неверный год')
+			return
+		if self.check_not_modified():
+			return
+		try:
+			boilers = yield get_boilers_month_values(
+				self.get_analytics_reader(), year, month,
+				columns)
 		except:
 			logger.exception('Error with getting month parameter')
-			if tx:
-				tx.rollback()
 			self.render_json_error('На сервере произошла ошибка, '\
 					       'обратитесь к администратору')
 			return
+		self.render_series_json(boilers, 2)
+
+##
+# Get values of several (boiler, parameter) series along the
+# specified year or month by one request. Series are passed as
+# 'series[]' arguments in the format 'boiler_id:parameter'.
+# The response has the format:
+# {
+# 	boiler_id: {
+# 		parameter: { day1: val1, day2: val2, ... },
+# 		...
+# 	},
+# 	...
+# }
+# Days are numbered from the start of the year, or from the start
+# of the month, if the month is specified.
+#
+class GetParametersHandler(BaseHandler):
+	##
+	# Get the requested series along the year. The database is
+	# accessed only if some of them are not cached.
+	# @param year     Year of the series.
+	# @param requests Dictionary { boiler id: list of parameters }.
+	#
+	@tornado.gen.coroutine
+	def get_year_series(self, year, requests):
+		series = yield cache.year_series.load_many(application.reader,
+							   year, requests)
+		res = {}
+		for boiler_id, cols in requests.items():
+			res[boiler_id] = {}
+			for col in cols:
+				values = series[boiler_id][col]
+				res[boiler_id][col] = cache.get_series_days(values)
+		return res
+
+	##
+	# Get the requested series along the month by one query.
+	# @param year     Year of the series.
+	# @param month    Month of the series.
+	# @param requests Dictionary { boiler id: list of parameters }.
+	#
+	@tornado.gen.coroutine
+	def get_month_series(self, year, month, requests):
+		cols = set()
+		for boiler_cols in requests.values():
+			cols.update(boiler_cols)
+		values = yield get_boilers_month_values(
+			self.get_analytics_reader(), year, month, sorted(cols),
+			list(requests))
+		res = {}
+		for boiler_id, cols in requests.items():
+			res[boiler_id] = {}
+			params = values.get(boiler_id, {})
+			for col in cols:
+				res[boiler_id][col] = params.get(col, {})
+		return res
+
+	@tornado.gen.coroutine
+	@tornado.web.authenticated
+	def get(self):
+		if not self.check_rights(CAN_SEE_REPORTS, render=False):
+			self.render_json_error('У вас нет прав на это действие')
+			return
+		year = self.get_argument('year', None)
+		if year is None:
+			self.render_json_error('Не указан год')
+			return
+		month = self.get_argument('month', None)
+		series_bin = self.request.arguments.get('series[]', None)
+		if not series_bin:
+			self.render_json_error('Не указаны параметры')
+			return
+		if len(series_bin) > max_series_count:
+			self.render_json_error('Слишком много параметров')
+			return
+		#
+		# { boiler_id: [ parameter, ... ] }
+		#
+		requests = {}
+		try:
+			year = int(year)
+			if month is not None:
+				month = int(month)
+				if month < 1 or month > 12:
+					raise ValueError('Illegal month')
+			for series in series_bin:
+				boiler_id, param = series.decode('utf-8')\
+							 .split(':')
+				boiler_id = int(boiler_id)
+				#
+				# Protect from SQL injection
+				#
+				if param not in boiler_room_report_cols:
+					self.render_json_error('Нельзя получать '\
+							       'столбец {}'\
+							       .format(param))
+					return
+				if boiler_id not in requests:
+					requests[boiler_id] = []
+				if param not in requests[boiler_id]:
+					requests[boiler_id].append(param)
+		except ValueError:
+			self.render_json_error('Неверные параметры')
+			return
+		if self.check_not_modified():
+			return
+		try:
+			if month is None:
+				res = yield self.get_year_series(year, requests)
+			else:
+				res = yield self.get_month_series(year, month,
+								  requests)
+		except:
+			logger.exception('Error with getting parameters')
+			self.render_json_error('На сервере произошла ошибка, '\
+					       'обратитесь к администратору')
+			return
+		self.render_series_json(res, 2)
+
+##
+# Get values of parameters along an arbitrary range of dates with
+# the day, week or month resolution, for example, along a heating
+# season. Arguments:
+# from, to     - first and last days of the range, 'yyyy-mm-dd';
+# resolution   - 'day', 'week' or 'month', default is 'day';
+# aggregate    - 'avg', 'sum', 'min' or 'max', default is 'avg';
+# columns[]    - parameters;
+# boiler_ids[] - boiler rooms, optional. If not specified, then
+#                values are aggregated along all boiler rooms.
+# @sa get_range_values() for the response format.
+#
+class GetRangeParametersHandler(BaseHandler):
+	max_range_days = 366 * 10
+
+	@tornado.gen.coroutine
+	@tornado.web.authenticated
+	def get(self):
+		if not self.check_rights(CAN_SEE_REPORTS, render=False):
+			self.render_json_error('У вас нет прав на это действие')
+			return
+		resolution = self.get_argument('resolution', 'day')
+		if resolution not in range_resolutions:
+			self.render_json_error('Неверное разрешение')
+			return
+		aggregate = self.get_argument('aggregate', 'avg')
+		if aggregate not in range_aggregates:
+			self.render_json_error('Неверная функция агрегации')
+			return
+		try:
+			date_from = datetime.strptime(self.get_argument('from'),
+						      db_date_format).date()
+			date_to = datetime.strptime(self.get_argument('to'),
+						    db_date_format).date()
+		except (tornado.web.MissingArgumentError, ValueError):
+			self.render_json_error('Не указан или неверен диапазон '\
+					       'дат')
+			return
+		days = (date_to - date_from).days
+		if days < 0 or days > GetRangeParametersHandler.max_range_days:
+			self.render_json_error('Неверный диапазон дат')
+			return
+		columns = []
+		for col in self.request.arguments.get('columns[]', []):
+			col = col.decode('utf-8')
+			#
+			# Protect from SQL injection
+			#
+			if col not in boiler_room_report_cols:
+				self.render_json_error('Нельзя получать '\
+						       'столбец {}'.format(col))
+				return
+			columns.append(col)
+		if not columns:
+			self.render_json_error('Не указаны колонки')
+			return
+		ids = None
+		ids_bin = self.request.arguments.get('boiler_ids[]', None)
+		if ids_bin:
+			try:
+				ids = [int(id) for id in ids_bin]
+			except ValueError:
+				self.render_json_error('Неверный идентификатор '\
+						       'бойлерной')
+				return
+		if self.check_not_modified():
+			return
+		try:
+			res = yield get_range_values(self.get_analytics_reader(),
+						     date_from, date_to,
+						     columns, resolution,
+						     aggregate, ids)
+		except:
+			logger.exception('Error with getting range parameters')
+			self.render_json_error('На сервере произошла ошибка, '\
+					       'обратитесь к администратору')
+			return
+		self.render_json(res)
+
+##
+# Get dates of the reports along several years by one request.
+# Argument 'years[]' - list of years. The response has the format:
+# { year: bitmap }, where bitmap is a hex string.
+# @sa cache.encode_date_bitmap().
+#
+class GetReportDatesHandler(BaseHandler):
+	max_years_count = 50
+
+	@tornado.gen.coroutine
+	@tornado.web.authenticated
+	def get(self):
+		if not self.check_rights(CAN_SEE_REPORTS, render=False):
+			self.render_json_error('У вас нет прав на это действие')
+			return
+		years_bin = self.request.arguments.get('years[]', None)
+		if not years_bin:
+			self.render_json_error('Не указаны годы')
+			return
+		if len(years_bin) > GetReportDatesHandler.max_years_count:
+			self.render_json_error('Слишком много лет')
+			return
+		try:
+			years = sorted(set([int(year) for year in years_bin]))
+		except ValueError:
+			self.render_json_error('Неверный год')
+			return
+		if self.check_not_modified():
+			return
+		try:
+			bitmaps = yield cache.report_dates.load_many(
+				application.reader, years)
+		except:
+			logger.exception('Error with getting report dates')
+			self.render_json_error('На сервере произошла ошибка, '\
+					       'обратитесь к администратору')
+			return
+		res = {}
+		for year, bitmap in bitmaps.items():
+			res[year] = cache.encode_date_bitmap(bitmap)
+		self.render_json(res)
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='VolComHoz')
@@ -260,6 +528,13 @@ if __name__ == "__main__":
 			    help='Port for the server running')
 	parser.add_argument('--test', action='store_true', default=False)
 	parser.add_argument('--test_args', nargs='*')
+	parser.add_argument('--production', action='store_true',
+			    default=False,
+			    help='Run without autoreload in several worker '\
+				 'processes')
+	parser.add_argument('--workers', '-w', type=int, default=0,
+			    help='Count of worker processes in the '\
+				 'production mode, 0 - by count of CPU cores')
 	args = parser.parse_args()
 	secret_conf.parse_config()
 	max_conn = secret_conf.max_db_connections
@@ -276,9 +551,32 @@ if __name__ == "__main__":
 		'user': secret_conf.db_user,
 		'passwd': secret_conf.db_passwd,
 		'db': db_name,
-		'charset': secret_conf.db_charset
+		'charset': secret_conf.db_charset,
+		#
+		# Reads are executed out of transactions by
+		# application.reader. Writes start transactions
+		# explicitly by application.begin().
+		#
+		'autocommit': True
 	}
-	application.connect_db()
+	#
+	# Replicas inherit all the arguments of the primary except
+	# the specified ones. Tests use the primary only.
+	#
+	application.replica_db_args = []
+	if not args.test:
+		for replica in secret_conf.db_replicas:
+			replica_args = dict(application.connect_db_args)
+			replica_args['host'] = replica['db_host']
+			if 'db_port' in replica:
+				replica_args['port'] = replica['db_port']
+			if 'db_user' in replica:
+				replica_args['user'] = replica['db_user']
+			if 'db_passwd' in replica:
+				replica_args['passwd'] = replica['db_passwd']
+			application.replica_db_args.append(replica_args)
+	application.read_your_writes_seconds =\
+		secret_conf.read_your_writes_seconds
 	application.handlers_list = [
 		(r'/', MainHandler),
 		(r'/upload', UploadHandler),
@@ -291,6 +589,9 @@ if __name__ == "__main__":
 		(r'/get_year_parameter', GetYearParameterHandler),
 		(r'/temperature', TemperatureHandler),
 		(r'/get_month_parameter', GetMonthParameterHandler),
+		(r'/get_parameters', GetParametersHandler),
+		(r'/get_range_parameters', GetRangeParametersHandler),
+		(r'/get_report_dates', GetReportDatesHandler),
 		(r'/users_management', UsersManagementHandler)
 	]
 	application.template_path = 'templates/'
@@ -301,21 +602,66 @@ if __name__ == "__main__":
 	sh = logging.StreamHandler()
 	sh.setFormatter(formatter)
 	logger.addHandler(sh)
-	logger.debug("Server is started on %s" % args.port)
 	if args.test:
+		#
+		# Test suites are found by unittest.main() in this
+		# module, so they are imported only for tests.
+		#
+		from tests_prepare_suite     import AAA_TestSuitePrepare
+		from test_login_logout_suite import TestSuiteLoginLogout
+		from test_users_management   import TestSuiteUsersManagement
+		application.connect_db()
+		application.start_parse_executor(secret_conf.parse_workers,
+						 secret_conf.parse_use_processes,
+						 secret_conf.parse_queue_size,
+						 secret_conf.parse_timeout)
+		application.start_hash_executor(secret_conf.hash_workers,
+						secret_conf.hash_use_processes,
+						secret_conf.hash_queue_size)
+		logger.debug("Server is started on %s" % args.port)
 		argv = [sys.argv[0], ]
 		if args.test_args:
 			argv.extend(args.test_args)
 		sys.argv = argv
 		unittest.main()
 	else:
+		#
+		# The socket is bound before the fork, so all the
+		# workers accept connections from the same port. The
+		# database pools, the executors and the IOLoop must be
+		# created after the fork - each worker has its own.
+		#
+		sockets = tornado.netutil.bind_sockets(args.port)
+		if args.production:
+			task_id = tornado.process.fork_processes(args.workers)
+			logger.debug("Worker %s is started" % task_id)
+		application.connect_db()
+		application.start_replica_checks(
+			secret_conf.replica_check_interval)
+		#
+		# The caches of the workers and of other server
+		# instances are kept coherent via the database.
+		#
+		tornado.ioloop.IOLoop.current().run_sync(
+			lambda: cache.changes.init(application.reader))
+		cache.changes.start(application.reader,
+				    secret_conf.cache_poll_interval)
+		application.start_parse_executor(secret_conf.parse_workers,
+						 secret_conf.parse_use_processes,
+						 secret_conf.parse_queue_size,
+						 secret_conf.parse_timeout)
+		application.start_hash_executor(secret_conf.hash_workers,
+						secret_conf.hash_use_processes,
+						secret_conf.hash_queue_size)
 		application.app = tornado.web.Application(
 			handlers=application.handlers_list,
-			autoreload=True,
+			autoreload=not args.production,
 			template_path=application.template_path,
 			static_path=application.static_path,
 			cookie_secret=secret_conf.cookie_secret,
 			login_url=application.login_url
 		)
-		application.app.listen(args.port)
+		server = tornado.httpserver.HTTPServer(application.app)
+		server.add_sockets(sockets)
+		logger.debug("Server is started on %s" % args.port)
 		tornado.ioloop.IOLoop.current().start()
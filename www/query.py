@@ -2,11 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import calendar
-from datetime import date as libdate
+from datetime import date as libdate, timedelta
 
 import tornado
 import tornado.gen
-from constants import date_format, AccessError
+from constants import date_format, db_date_format, AccessError, \
+		      NameCollisionError
 
 boiler_room_report_cols = [
 	'T1', 'T2', 'gas_pressure',
@@ -24,6 +25,43 @@ boiler_room_report_cols = [
 	'hardness', 'transparency'
 ]
 
+##
+# Columns of daily_rollups and monthly_rollups tables: sum_<col> and
+# avg_<col> for each column of boiler_room_report_cols, and the
+# aggregates, by which they are calculated.
+#
+rollup_cols = []
+rollup_aggregates = []
+for col in boiler_room_report_cols:
+	rollup_cols.extend(['sum_' + col, 'avg_' + col])
+	rollup_aggregates.extend(['SUM({})'.format(col),
+				  'AVG({})'.format(col)])
+
+##
+# Get bounds of the year for filtering by the date column. Unlike
+# YEAR(date) = year, the range predicate can use the date index.
+# @param year Year, integer or string.
+#
+# @retval Tuple (first day of the year, first day of the next year).
+#
+def get_year_range(year):
+	year = int(year)
+	return (libdate(year, 1, 1), libdate(year + 1, 1, 1))
+
+##
+# Get bounds of the month for filtering by the date column.
+# @param year  Year, integer or string.
+# @param month Month from 1 to 12, integer or string.
+#
+# @retval Tuple (first day of the month, first day of the next month).
+#
+def get_month_range(year, month):
+	year = int(year)
+	month = int(month)
+	if month == 12:
+		return (libdate(year, 12, 1), libdate(year + 1, 1, 1))
+	return (libdate(year, month, 1), libdate(year, month + 1, 1))
+
 ##
 # {
 # 	boiler_id: {
@@ -36,13 +74,19 @@ boiler_room_report_cols = [
 # 	},
 # 	...
 # }
+# @param boiler_ids If specified, then only these boiler rooms are
+#                   fetched.
 #
 @tornado.gen.coroutine
-def get_boilers_month_values(tx, year, month, columns):
+def get_boilers_month_values(tx, year, month, columns, boiler_ids=None):
 	sql = 'SELECT boiler_room_id, DAY(date), {} FROM boiler_room_reports JOIN reports'\
 	      ' ON(report_id = reports.id) WHERE '\
-	      'YEAR(date) = %s AND MONTH(date) = %s'.format(",".join(columns))
-	params = (year, month)
+	      'date >= %s AND date < %s'.format(",".join(columns))
+	params = get_month_range(year, month)
+	if boiler_ids is not None:
+		sql += ' AND boiler_room_id IN ({})'\
+		       .format(','.join(['%s'] * len(boiler_ids)))
+		params += tuple(boiler_ids)
 	cursor = yield tx.execute(query=sql, params=params)
 	boilers = {}
 	row = cursor.fetchone()
@@ -100,33 +144,18 @@ def get_districts_with_boilers(tx):
 	return result
 
 ##
-# Get a report for the specified date.
-# @param tx   Current transaction.
-# @param date Date on which need to find a report.
-# @param cols String with columns separated by commas: 'id, name, ...'.
-#
-# @retval Tuple with specified columns or the empty tuple.
+# Get dates of all reports in the range.
+# @param tx    Current transaction.
+# @param start First day of the range, datetime.date.
+# @param end   Day after the last day of the range, datetime.date.
 #
-@tornado.gen.coroutine
-def get_report_by_date(tx, date, cols):
-	sql = "SELECT {} FROM reports WHERE date = "\
-	      "STR_TO_DATE(%s, %s)".format(','.join(cols))
-	params = (date, date_format)
-	cursor = yield tx.execute(query=sql, params=params)
-	return cursor.fetchone()
-
-##
-# Get report days and months by the given year.
-# @param tx   Current transaction.
-# @param year Year which need to find.
+# @retval List of datetime.date.
 #
 @tornado.gen.coroutine
-def get_report_dates_by_year(tx, year):
-	sql = "SELECT month(date) as month, day(date) as day "\
-	      "FROM reports WHERE year(date) = %s"
-	params = (year, )
-	cursor = yield tx.execute(query=sql, params=params)
-	return cursor.fetchall()
+def get_report_dates_by_range(tx, start, end):
+	sql = "SELECT date FROM reports WHERE date >= %s AND date < %s"
+	cursor = yield tx.execute(query=sql, params=(start, end))
+	return [row[0] for row in cursor.fetchall()]
 
 ##
 # Get identifiers and titles of all boiler rooms.
@@ -162,28 +191,192 @@ def get_boiler_room_ids_and_titles(tx):
 #
 @tornado.gen.coroutine
 def get_boiler_year_report(tx, id, year, cols):
-	sql = "SELECT date, {} FROM reports JOIN boiler_room_reports "\
-	      "ON(reports.id = report_id) WHERE YEAR(date) = %s AND "\
-	      "boiler_room_id = %s"\
-	      .format(",".join(cols))
-	params = (year, id)
-	res = {}
+	id = int(id)
+	res = yield get_boilers_year_report(tx, [id, ], year, cols)
+	return res[id]
+
+##
+# Get parameters of several boiler rooms along the year by one query.
+# @param tx   Current transaction.
+# @param ids  List of boiler room identifiers.
+# @param year Year along which need to gather parameters.
+# @param cols List of the table columns needed to fetch.
+#
+# @retval Dictionary { boiler_id: parameters } where parameters are in
+#         the format of get_boiler_year_report().
+#
+@tornado.gen.coroutine
+def get_boilers_year_report(tx, ids, year, cols):
 	#
 	# Validate columns and prepare the result dictionary.
 	#
 	for col in cols:
 		if col not in boiler_room_report_cols:
 			raise AccessError('[{}]'.format(','.join(cols)))
-		res[col] = {}
+	ids = [int(id) for id in ids]
+	res = {}
+	for id in ids:
+		res[id] = {}
+		for col in cols:
+			res[id][col] = {}
+	sql = "SELECT boiler_room_id, date, {} FROM reports JOIN "\
+	      "boiler_room_reports ON(reports.id = report_id) WHERE "\
+	      "date >= %s AND date < %s AND boiler_room_id IN ({})"\
+	      .format(",".join(cols), ','.join(['%s'] * len(ids)))
+	params = get_year_range(year) + tuple(ids)
 	cursor = yield tx.execute(query=sql, params=params)
 	row = cursor.fetchone()
 	while row:
-		day = row[0].timetuple().tm_yday
+		boiler = res[row[0]]
+		day = row[1].timetuple().tm_yday
 		for i, col in enumerate(cols):
-			res[col][day] = row[1 + i]
+			boiler[col][day] = row[2 + i]
 		row = cursor.fetchone()
 	return res
 
+##
+# SQL expressions, which map a report date to the first day of its
+# period for each resolution of get_range_values().
+#
+range_resolutions = {
+	'day': 'date',
+	'week': 'DATE_SUB(date, INTERVAL WEEKDAY(date) DAY)',
+	'month': 'DATE_SUB(date, INTERVAL DAYOFMONTH(date) - 1 DAY)'
+}
+
+##
+# Aggregate functions available in get_range_values().
+#
+range_aggregates = {
+	'avg': 'AVG',
+	'sum': 'SUM',
+	'min': 'MIN',
+	'max': 'MAX'
+}
+
+##
+# Get sums or averages of parameters along all boiler rooms from the
+# daily and monthly rollups. The result is the same as from the raw
+# reports, but only one row per day or month is read.
+# @sa get_range_values().
+#
+# @retval     None The values can not be calculated from the rollups:
+#                  the aggregate is neither 'sum' nor 'avg', or the
+#                  average is requested by weeks or by months cut
+#                  by the range.
+# @retval not None Result of get_range_values().
+#
+@tornado.gen.coroutine
+def get_rollup_range_values(tx, date_from, date_to, cols, resolution,
+			    aggregate):
+	if aggregate not in ('sum', 'avg'):
+		return None
+	end = date_to + timedelta(days=1)
+	rollup_list = ['{}_{}'.format(aggregate, col) for col in cols]
+	if resolution == 'day':
+		sql = 'SELECT date, {} FROM daily_rollups WHERE date >= %s '\
+		      'AND date < %s'.format(','.join(rollup_list))
+	elif resolution == 'month' and date_from.day == 1 and end.day == 1:
+		sql = 'SELECT month, {} FROM monthly_rollups WHERE '\
+		      'month >= %s AND month < %s'.format(','.join(rollup_list))
+	elif aggregate == 'sum':
+		#
+		# Weeks or months, cut by the range, are summed from
+		# the days of the range.
+		#
+		sum_list = ['SUM({})'.format(col) for col in rollup_list]
+		sql = 'SELECT {} AS period, {} FROM daily_rollups WHERE '\
+		      'date >= %s AND date < %s GROUP BY period'\
+		      .format(range_resolutions[resolution],
+			      ','.join(sum_list))
+	else:
+		return None
+	cursor = yield tx.execute(query=sql, params=(date_from, end))
+	res = {}
+	for row in cursor.fetchall():
+		if 'all' not in res:
+			res['all'] = {}
+			for col in cols:
+				res['all'][col] = {}
+		period = row[0].strftime(db_date_format)
+		for i, col in enumerate(cols):
+			res['all'][col][period] = row[1 + i]
+	return res
+
+##
+# Get parameters of boiler rooms along an arbitrary range of dates,
+# aggregated by days, weeks or months. All is done by one query. Sums
+# and averages along all boiler rooms are read from the rollups, when
+# it is possible. @sa get_rollup_range_values().
+# @param tx         Current transaction.
+# @param date_from  First day of the range, datetime.date.
+# @param date_to    Last day of the range, datetime.date.
+# @param cols       List of the table columns needed to fetch.
+# @param resolution Key of range_resolutions.
+# @param aggregate  Key of range_aggregates.
+# @param ids        List of boiler room identifiers or None. If None,
+#                   then values are aggregated along all boiler rooms.
+#
+# @retval Dictionary with the following format, where periods are
+#         first days of weeks or months in the 'yyyy-mm-dd' format,
+#         and boiler_id is 'all', if ids are not specified:
+# {
+# 	boiler_id: {
+# 		parameter: {
+# 			period1: val1,
+# 			period2: val2,
+# 			...
+# 		},
+# 		...
+# 	},
+# 	...
+# }
+#
+@tornado.gen.coroutine
+def get_range_values(tx, date_from, date_to, cols, resolution, aggregate,
+		     ids=None):
+	for col in cols:
+		if col not in boiler_room_report_cols:
+			raise AccessError('[{}]'.format(','.join(cols)))
+	if ids is None:
+		res = yield get_rollup_range_values(tx, date_from, date_to,
+						    cols, resolution,
+						    aggregate)
+		if res is not None:
+			return res
+	period = range_resolutions[resolution]
+	func = range_aggregates[aggregate]
+	agg_list = ['{}({})'.format(func, col) for col in cols]
+	boiler_col = 'NULL'
+	group_by = 'period'
+	if ids is not None:
+		boiler_col = 'boiler_room_id'
+		group_by = 'boiler_room_id, period'
+	sql = 'SELECT {}, {} AS period, {} FROM reports JOIN '\
+	      'boiler_room_reports ON(reports.id = report_id) WHERE '\
+	      'date >= %s AND date < %s'\
+	      .format(boiler_col, period, ','.join(agg_list))
+	params = (date_from, date_to + timedelta(days=1))
+	if ids is not None:
+		sql += ' AND boiler_room_id IN ({})'\
+		       .format(','.join(['%s'] * len(ids)))
+		params += tuple(ids)
+	sql += ' GROUP BY {}'.format(group_by)
+	cursor = yield tx.execute(query=sql, params=params)
+	res = {}
+	for row in cursor.fetchall():
+		boiler_id = row[0]
+		if ids is None:
+			boiler_id = 'all'
+		if boiler_id not in res:
+			res[boiler_id] = {}
+			for col in cols:
+				res[boiler_id][col] = {}
+		period = row[1].strftime(db_date_format)
+		for i, col in enumerate(cols):
+			res[boiler_id][col][period] = row[2 + i]
+	return res
+
 ##
 # Get air temperature of all days in the specified year.
 # @param year Year in which need to get air temperatures.
@@ -192,8 +385,9 @@ def get_boiler_year_report(tx, id, year, cols):
 #
 @tornado.gen.coroutine
 def get_year_temperature(tx, year):
-	sql = "SELECT date, temp_average_air FROM reports WHERE YEAR(date) = %s"
-	params = (year, )
+	sql = "SELECT date, temp_average_air FROM reports WHERE date >= %s "\
+	      "AND date < %s"
+	params = get_year_range(year)
 	cursor = yield tx.execute(query=sql, params=params)
 	data = cursor.fetchall()
 	res = {}
@@ -213,74 +407,121 @@ def delete_report_by_date(tx, date):
 	return cursor.fetchone()
 
 ##
-# Get a district by the name.
-# @param name District name.
-# @param cols String with columns separated by commas: 'id, name', for example.
+# Get a key, by which the districts and the boiler rooms are found in
+# the cache. It only approximates the collation of the name columns,
+# so a name, missed by the key, can still exist in the database.
+# @sa insert_district(), insert_boiler_room().
+#
+def get_name_key(name):
+	return name.lower()
+
+##
+# Get identifiers of all districts.
+# @param tx Current transaction.
 #
-# @retval Tuple with found distict or the empty tuple.
+# @retval Dictionary { get_name_key(name): district id }.
 #
 @tornado.gen.coroutine
-def get_district_by_name(tx, name, cols):
-	sql = "SELECT {} FROM districts WHERE name = %s".format(','.join(cols))
-	params = (name, )
-	cursor = yield tx.execute(query=sql, params=params)
-	return cursor.fetchone()
+def get_district_ids(tx):
+	sql = "SELECT id, name FROM districts"
+	cursor = yield tx.execute(query=sql)
+	res = {}
+	for row in cursor.fetchall():
+		res[get_name_key(row[1])] = row[0]
+	return res
 
 ##
-# Insert the new district to the districts table.
+# Check, that the row, returned by the insert with ON DUPLICATE KEY,
+# has the same full name. The unique keys on the names are built by
+# prefixes, so different long names can be duplicates by the key.
+# @param tx    Current transaction.
+# @param table Table with the 'id' and 'name' columns.
+# @param id    Identifier of the row.
+# @param name  Inserted name.
+#
+# @exception NameCollisionError The row has another name.
+#
+@tornado.gen.coroutine
+def check_inserted_name(tx, table, id, name):
+	sql = 'SELECT name = %s FROM {} WHERE id = %s'.format(table)
+	cursor = yield tx.execute(query=sql, params=(name, id))
+	row = cursor.fetchone()
+	if not row or not row[0]:
+		raise NameCollisionError(name)
+
+##
+# Insert the new district to the districts table. If a district with
+# the name, equal by the collation, already exists, then it is not
+# changed.
+# @exception NameCollisionError Another district has the same
+#                               prefix of the name.
+# @retval Identifier of the new or the existing district.
 #
 @tornado.gen.coroutine
 def insert_district(tx, name):
-	sql = "INSERT INTO districts(name) VALUES (%s)"
+	sql = "INSERT INTO districts(name) VALUES (%s) "\
+	      "ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)"
 	params = (name, )
-	yield tx.execute(query=sql, params=params)
+	cursor = yield tx.execute(query=sql, params=params)
+	yield check_inserted_name(tx, 'districts', cursor.lastrowid, name)
+	return cursor.lastrowid
 
 ##
-# Get a boiler room by the specified district identifier and the boiler room
-# name.
-# @param tx      Current transaction.
-# @param cols    String with columns separated by commas: 'id, name, ...'.
-# @param dist_id Identifier of the district - 'id' from 'districts' table.
-# @param name    Name of the boiler room.
+# Get identifiers of all boiler rooms.
+# @param tx Current transaction.
 #
-# @retval Tuple with specified columns or the empty tuple.
+# @retval Dictionary { (district id, get_name_key(name)): room id }.
 #
 @tornado.gen.coroutine
-def get_boiler_room_by_dist_and_name(tx, cols, dist_id, name):
-	sql = "SELECT {} FROM boiler_rooms WHERE district_id = %s AND "\
-	      "name = %s".format(','.join(cols))
-	params = (dist_id, name)
-	cursor = yield tx.execute(query=sql, params=params)
-	return cursor.fetchone()
+def get_boiler_room_ids(tx):
+	sql = "SELECT id, district_id, name FROM boiler_rooms"
+	cursor = yield tx.execute(query=sql)
+	res = {}
+	for row in cursor.fetchall():
+		res[(row[1], get_name_key(row[2]))] = row[0]
+	return res
 
 ##
-# Insert the new boiler room to the boiler rooms table.
+# Insert the new boiler room to the boiler rooms table. If a boiler
+# room of the district with the name, equal by the collation, already
+# exists, then it is not changed.
 # @param tx      Current transaction.
 # @param dist_id Identifier of the district - 'id' from 'districts' table.
 # @param name    Name of the new boiler room.
 #
+# @exception NameCollisionError Another boiler room of the district
+#                               has the same prefix of the name.
+# @retval Identifier of the new or the existing boiler room.
+#
 @tornado.gen.coroutine
 def insert_boiler_room(tx, dist_id, name):
 	sql = "INSERT INTO boiler_rooms(district_id, name) "\
-	      "VALUES (%s, %s)"
+	      "VALUES (%s, %s) "\
+	      "ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)"
 	params = (dist_id, name)
-	yield tx.execute(query=sql, params=params)
+	cursor = yield tx.execute(query=sql, params=params)
+	yield check_inserted_name(tx, 'boiler_rooms', cursor.lastrowid,
+				  name)
+	return cursor.lastrowid
 
 ##
 # Insert a new user into the database.
 #
 @tornado.gen.coroutine
 def insert_user(tx, email, password, salt, name, rights):
-	sql = "INSERT INTO users VALUES (NULL, %s, %s, %s, %s, %s)"
+	sql = "INSERT INTO users(email, password, salt, name, rights) "\
+	      "VALUES (%s, %s, %s, %s, %s)"
 	params = (email, password, salt, name, rights)
 	yield tx.execute(query=sql, params=params)
 
 ##
-# Update the user by his identifier.
+# Update the user by his identifier. The version of the user is
+# incremented, so the issued sessions become outdated.
 #
 @tornado.gen.coroutine
 def update_user(tx, id, email, password, salt, name, rights):
-	sql = "UPDATE users SET email = %s, name = %s, rights = %s"
+	sql = "UPDATE users SET email = %s, name = %s, rights = %s, "\
+	      "version = version + 1"
 	params = [email, name, rights]
 	# Password update is optional.
 	if password and salt:
@@ -324,30 +565,36 @@ def get_html_float_to_str(src, name, precision=2):
 		return '-'
 
 ##
-# Insert the new report about the specified boiler room.
+# Insert reports about the boiler rooms by one multi-row statement.
 # @param tx        Current transaction.
-# @param src       Dictionary with the boiler room attributes.
-# @param room_id   Identifier of the boiler room - 'id' from
-#                  'boiler_rooms' table.
 # @param report_id Identifier of the report - 'id' from 'reports' table.
+# @param rooms     List of (room_id, src) pairs, where room_id is
+#                  'id' from 'boiler_rooms' table and src is a
+#                  dictionary with the boiler room attributes.
 #
 @tornado.gen.coroutine
-def insert_boiler_room_report(tx, src, room_id, report_id):
-	assert(room_id)
+def insert_boiler_room_reports(tx, report_id, rooms):
 	assert(report_id)
-	params = [room_id, report_id]
-	values = ['%s', '%s']
-	for i in range(len(boiler_room_report_cols)):
-		values.append('%s')
-	values = ','.join(values)
-	sql = 'INSERT INTO boiler_room_reports VALUES (NULL, {})'.format(values)
-	for col in boiler_room_report_cols:
-		params.append(get_safe_val(src, col))
-	yield tx.execute(query=sql, params=params)
+	cols = ['boiler_room_id', 'report_id'] + boiler_room_report_cols
+	#
+	# The columns are listed explicitly, so the driver can
+	# join all rows into one INSERT ... VALUES (...), (...).
+	#
+	sql = 'INSERT INTO boiler_room_reports({}) VALUES ({})'\
+	      .format(','.join(cols), ','.join(['%s'] * len(cols)))
+	params = []
+	for room_id, src in rooms:
+		assert(room_id)
+		row = [room_id, report_id]
+		for col in boiler_room_report_cols:
+			row.append(get_safe_val(src, col))
+		params.append(row)
+	yield tx.executemany(query=sql, params=params)
 
 ##
 # Insert a report to the reports table. If some columns absense then replace
 # them with NULL values.
+# @retval Identifier of the inserted report.
 #
 @tornado.gen.coroutine
 def insert_report(tx, author_id, src):
@@ -367,18 +614,20 @@ def insert_report(tx, author_id, src):
 		  get_safe_val(src, 'forecast_temp_day_to'),
 		  get_safe_val(src, 'forecast_temp_night_from'),
 		  get_safe_val(src, 'forecast_temp_night_to'))
-	yield tx.execute(query=sql, params=params)
+	cursor = yield tx.execute(query=sql, params=params)
+	return cursor.lastrowid
 
 ##
-# Get all boiler room reports by the specified date, joined with corresponding
-# district and boiler room names.
+# Get the report by the specified date without boiler room reports.
 # @param tx   Current transaction.
-# @param date Date by which need to find all reports.
+# @param date Date of the report in the date_format.
 #
-# @retval Array of tuples.
+# @retval     None The report is not found.
+# @retval not None Dictionary with the report attributes and the author
+#                  name.
 #
 @tornado.gen.coroutine
-def get_full_report_by_date(tx, date):
+def get_report_header_by_date(tx, date):
 	sql = 'SELECT reports.*, users.name FROM reports LEFT JOIN users '\
 	      'ON (author_id = users.id) WHERE date = STR_TO_DATE(%s, %s)'
 	params = (date, date_format)
@@ -386,14 +635,45 @@ def get_full_report_by_date(tx, date):
 	report = cursor.fetchone()
 	if not report:
 		return None
-	rep_id = report[0]
+	result = {}
+	result['id'] = report[0]
+	result['date'] = report[2]
+	result['temp_average_air'] = report[3]
+	result['temp_average_water'] = report[4]
+	result['expected_temp_air_day'] = report[5]
+	result['expected_temp_air_night'] = report[6]
+	result['expected_temp_air_all_day'] = report[7]
+	result['forecast_date'] = report[8]
+	result['forecast_weather'] = report[9]
+	result['forecast_direction'] = report[10]
+	result['forecast_speed'] = report[11]
+	result['forecast_temp_day_from'] = report[12]
+	result['forecast_temp_day_to'] = report[13]
+	result['forecast_temp_night_from'] = report[14]
+	result['forecast_temp_night_to'] = report[15]
+	result['author'] = report[16]
+	return result
+
+##
+# Get all boiler room reports by the specified date, joined with corresponding
+# district and boiler room names.
+# @param tx   Current transaction.
+# @param date Date by which need to find all reports.
+#
+# @retval Array of tuples.
+#
+@tornado.gen.coroutine
+def get_full_report_by_date(tx, date):
+	result = yield get_report_header_by_date(tx, date)
+	if not result:
+		return None
 	sql = 'SELECT districts.name, boiler_rooms.name, {} '\
 	      'FROM districts JOIN boiler_rooms '\
 	      'ON(districts.id = boiler_rooms.district_id) '\
 	      'JOIN boiler_room_reports '\
 	      'ON (boiler_room_reports.boiler_room_id = '\
 		  'boiler_rooms.id AND boiler_room_reports.report_id = {})'\
-	      .format(",".join(boiler_room_report_cols), rep_id)
+	      .format(",".join(boiler_room_report_cols), result['id'])
 	cursor = yield tx.execute(sql)
 	#
 	# First, create a dictionary of the following format:
@@ -421,22 +701,6 @@ def get_full_report_by_date(tx, date):
 			i += 1
 		rooms.append(next_report)
 		next_row = cursor.fetchone()
-	result = {}
-	result['date'] = report[2]
-	result['temp_average_air'] = report[3]
-	result['temp_average_water'] = report[4]
-	result['expected_temp_air_day'] = report[5]
-	result['expected_temp_air_night'] = report[6]
-	result['expected_temp_air_all_day'] = report[7]
-	result['forecast_date'] = report[8]
-	result['forecast_weather'] = report[9]
-	result['forecast_direction'] = report[10]
-	result['forecast_speed'] = report[11]
-	result['forecast_temp_day_from'] = report[12]
-	result['forecast_temp_day_to'] = report[13]
-	result['forecast_temp_night_from'] = report[14]
-	result['forecast_temp_night_to'] = report[15]
-	result['author'] = report[16]
 	result['districts'] = []
 	for dist, rooms in sorted(districts.items(), key=lambda x: x[0]):
 		district = {'name': dist}
@@ -447,9 +711,173 @@ def get_full_report_by_date(tx, date):
 		result['districts'].append(district)
 	return result
 
+##
+# Get the pre-rendered HTML table of the boiler room reports.
+# @param tx        Current transaction.
+# @param report_id Identifier of the report.
+# @param version   Version of the snapshot format. Snapshots of
+#                  other versions are ignored.
+#
+# @retval     None The snapshot is not found.
+# @retval not None Compressed HTML.
+#
+@tornado.gen.coroutine
+def get_report_snapshot(tx, report_id, version):
+	sql = 'SELECT html FROM report_snapshots WHERE report_id = %s AND '\
+	      'version = %s'
+	cursor = yield tx.execute(query=sql, params=(report_id, version))
+	row = cursor.fetchone()
+	if not row:
+		return None
+	return row[0]
+
+##
+# Insert or replace the pre-rendered HTML table of the boiler room
+# reports.
+# @param tx        Current transaction.
+# @param report_id Identifier of the report.
+# @param version   Version of the snapshot format.
+# @param html      Compressed HTML.
+#
+@tornado.gen.coroutine
+def insert_report_snapshot(tx, report_id, version, html):
+	sql = 'INSERT INTO report_snapshots(report_id, version, html) '\
+	      'VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE '\
+	      'version = VALUES(version), html = VALUES(html)'
+	yield tx.execute(query=sql, params=(report_id, version, html))
+
+##
+# Count of the last data changes, which are kept in the data_changes
+# table. Older ones are deleted.
+#
+max_data_changes = 1000
+
+##
+# Register a change of the reports data and get its version. Must be
+# called in the transaction which changes the data. The row of the
+# counter stays locked until the end of the transaction, so the
+# versions of concurrent transactions become visible in the increasing
+# order.
+# @param tx             Current transaction.
+# @param date           Date of the changed report, datetime.date.
+# @param report_exists  True, if the report was inserted, false, if
+#                       it was deleted.
+# @param new_dimensions True, if new districts or boiler rooms were
+#                       inserted.
+#
+# @retval Version of the change.
+#
+@tornado.gen.coroutine
+def insert_data_change(tx, date, report_exists, new_dimensions):
+	version = yield insert_change(tx, date, report_exists,
+				      new_dimensions, None)
+	return version
+
+##
+# Register a change of the user and get its version. The change
+# invalidates the sessions of the user in all the server processes.
+# Must be called in the transaction which changes or deletes the
+# user.
+# @param tx      Current transaction.
+# @param user_id Identifier of the user.
+#
+# @retval Version of the change.
+# @sa insert_data_change().
+#
+@tornado.gen.coroutine
+def insert_user_change(tx, user_id):
+	version = yield insert_change(tx, None, None, None, user_id)
+	return version
+
+##
+# Insert a row into the data_changes log.
+# @sa insert_data_change(), insert_user_change().
+#
+@tornado.gen.coroutine
+def insert_change(tx, date, report_exists, new_dimensions, user_id):
+	sql = 'UPDATE data_version SET version = LAST_INSERT_ID(version + 1)'
+	yield tx.execute(sql)
+	cursor = yield tx.execute('SELECT LAST_INSERT_ID()')
+	version = cursor.fetchone()[0]
+	sql = 'INSERT INTO data_changes(version, date, report_exists, '\
+	      'new_dimensions, user_id, modified) VALUES (%s, %s, %s, '\
+	      '%s, %s, UTC_TIMESTAMP())'
+	params = (version, date, report_exists, new_dimensions, user_id)
+	yield tx.execute(query=sql, params=params)
+	if version > max_data_changes:
+		sql = 'DELETE FROM data_changes WHERE version <= %s'
+		params = (version - max_data_changes, )
+		yield tx.execute(query=sql, params=params)
+	return version
+
+##
+# Get the current version of the reports data.
+# @param tx Current transaction.
+#
+# @retval Tuple (version, time of the change in UTC). The time is
+#         None, if the data was never changed.
+#
+@tornado.gen.coroutine
+def get_data_version(tx):
+	sql = 'SELECT data_version.version, modified FROM data_version '\
+	      'LEFT JOIN data_changes USING(version)'
+	cursor = yield tx.execute(sql)
+	row = cursor.fetchone()
+	return (row[0], row[1]) if row else (0, None)
+
+##
+# Get the data changes, made after the specified version.
+# @param tx      Current transaction.
+# @param version Last known version.
+#
+# @retval List of tuples (version, date, report exists,
+#         new dimensions, user id, time of the change in UTC)
+#         ordered by version. The user id is not None only for
+#         changes of the users.
+#
+@tornado.gen.coroutine
+def get_data_changes(tx, version):
+	sql = 'SELECT version, date, report_exists, new_dimensions, '\
+	      'user_id, modified FROM data_changes WHERE version > %s '\
+	      'ORDER BY version'
+	cursor = yield tx.execute(query=sql, params=(version, ))
+	return cursor.fetchall()
+
+##
+# Recalculate daily and monthly rollups for the specified date. Must
+# be called in the same transaction in which a report on this date
+# is inserted or deleted.
+# @param tx   Current transaction.
+# @param date Date of the changed report, datetime.date.
+#
+@tornado.gen.coroutine
+def update_rollups(tx, date):
+	sql = 'DELETE FROM daily_rollups WHERE date = %s'
+	yield tx.execute(query=sql, params=(date, ))
+	sql = 'INSERT INTO daily_rollups(date, rooms_count, {}) '\
+	      'SELECT date, COUNT(*), {} FROM reports JOIN '\
+	      'boiler_room_reports ON(reports.id = report_id) '\
+	      'WHERE date = %s GROUP BY date'\
+	      .format(','.join(rollup_cols), ','.join(rollup_aggregates))
+	yield tx.execute(query=sql, params=(date, ))
+	month_range = get_month_range(date.year, date.month)
+	sql = 'DELETE FROM monthly_rollups WHERE month = %s'
+	yield tx.execute(query=sql, params=(month_range[0], ))
+	#
+	# The month is recalculated from the raw reports by the
+	# date range - it is at most a month of rooms.
+	#
+	sql = 'INSERT INTO monthly_rollups(month, days_count, rooms_count, '\
+	      '{}) SELECT %s, COUNT(DISTINCT date), COUNT(*), {} FROM '\
+	      'reports JOIN boiler_room_reports ON(reports.id = report_id) '\
+	      'WHERE date >= %s AND date < %s HAVING COUNT(*) > 0'\
+	      .format(','.join(rollup_cols), ','.join(rollup_aggregates))
+	params = (month_range[0], ) + month_range
+	yield tx.execute(query=sql, params=params)
+
 ##
 # Get summary values of all parameters for the specified month
-# in all boiler rooms.
+# in all boiler rooms. The values are read from daily_rollups.
 # @retval Dictionary with the following format:
 # {
 # 	parameter: {
@@ -462,11 +890,13 @@ def get_full_report_by_date(tx, date):
 #
 @tornado.gen.coroutine
 def get_sum_reports_by_month(tx, year, month, cols):
-	avg_list = list(['SUM({})'.format(col) for col in cols])
-	sql = 'SELECT DAY(date), {} FROM reports JOIN boiler_room_reports '\
-	      'ON(reports.id = report_id) WHERE MONTH(date) = %s and '\
-	      'YEAR(date) = %s GROUP BY date;'.format(",".join(avg_list))
-	params = (month, year)
+	for col in cols:
+		if col not in boiler_room_report_cols:
+			raise AccessError('[{}]'.format(','.join(cols)))
+	sum_list = list(['sum_{}'.format(col) for col in cols])
+	sql = 'SELECT DAY(date), {} FROM daily_rollups WHERE date >= %s and '\
+	      'date < %s'.format(",".join(sum_list))
+	params = get_month_range(year, month)
 	cursor = yield tx.execute(query=sql, params=params)
 	res = {}
 	for col in cols:
@@ -515,27 +945,79 @@ def get_user_by_email(tx, cols, email):
 	return process_db_row(tx, cols, row)
 
 ##
-# Get range of users with the specified offset and limit.
-# @param tx     Current transaction.
-# @param limit  Limit of users to fetch.
-# @param Offset Offset from the begin of all users list, ordered
-#               by name.
-# @param cols   List of columns to fetch.
+# Get a user by the specified identifier.
+# @param tx   Current transaction.
+# @param cols List of columns to fetch.
+# @param id   Identifier of the user.
 #
-# @retval List with the following format: [ { column values dictionary }, ... ].
+# @retval Dictionary with keys same as requested columns, or None,
+#         if an user was not found.
 #
 @tornado.gen.coroutine
-def get_users_range(tx, limit, offset, cols):
-	sql = 'SELECT {} FROM users ORDER BY name IS NULL, name ASC, email '\
-	      'LIMIT %s OFFSET %s'.format(','.join(cols))
-	params = (limit, offset)
+def get_user_by_id(tx, cols, id):
+	sql = "SELECT {} FROM users WHERE id = %s".format(','.join(cols))
+	params = (id, )
 	cursor = yield tx.execute(query=sql, params=params)
 	row = cursor.fetchone()
+	if not row:
+		return None
+	return process_db_row(tx, cols, row)
+
+##
+# Get a page of the users list. The list is ordered by name, email
+# and identifier, and the users without a name are the last. The page
+# is found by the position of the neighbour user instead of an offset
+# (keyset pagination), so any page costs the same as the first one:
+# the named and the unnamed users are read by range scans on the
+# name_email_id index.
+# @param tx       Current transaction.
+# @param cols     List of columns to fetch.
+# @param limit    Limit of users to fetch.
+# @param cursor   Tuple (name, email, id) of the user, after which
+#                 the page starts, or None for the first page.
+# @param backward If true, then the page ends before the cursor.
+#
+# @retval List with the following format: [ { column values dictionary }, ... ]
+#         in the order of the list.
+#
+@tornado.gen.coroutine
+def get_users_page(tx, cols, limit, cursor=None, backward=False):
+	#
+	# The list consists of two parts: named and unnamed users.
+	# Each part is read separately in the direction of the page.
+	#
+	parts = [ True, False ]
+	if backward:
+		parts.reverse()
+	if cursor is not None:
+		parts = parts[parts.index(cursor[0] is not None):]
 	res = []
-	while row:
-		next = process_db_row(tx, cols, row)
-		res.append(next)
-		row = cursor.fetchone()
+	for named in parts:
+		if len(res) >= limit:
+			break
+		if named:
+			sql = 'SELECT {} FROM users WHERE name IS NOT NULL'
+			keys = [ 'name', 'email', 'id' ]
+		else:
+			sql = 'SELECT {} FROM users WHERE name IS NULL'
+			keys = [ 'email', 'id' ]
+		sql = sql.format(','.join(cols))
+		params = []
+		if cursor is not None:
+			sql += ' AND ({}) {} ({})'.format(','.join(keys),
+							  '<' if backward else '>',
+							  ','.join(['%s'] * len(keys)))
+			params.extend(cursor[-len(keys):])
+			cursor = None
+		order = ' DESC' if backward else ''
+		sql += ' ORDER BY {} LIMIT %s'.format(
+			', '.join([key + order for key in keys]))
+		params.append(limit - len(res))
+		rows = yield tx.execute(query=sql, params=params)
+		res.extend([process_db_row(tx, cols, row)
+			    for row in rows.fetchall()])
+	if backward:
+		res.reverse()
 	return res
 
 ##
@@ -559,6 +1041,14 @@ def prepare_tests(tx, old_db_name, test_db_name):
 	      "CREATE TABLE boiler_rooms LIKE {}.boiler_rooms; "\
 	      "CREATE TABLE boiler_room_reports LIKE {}.boiler_room_reports; "\
 	      "CREATE TABLE users LIKE {}.users; "\
+	      "CREATE TABLE daily_rollups LIKE {}.daily_rollups; "\
+	      "CREATE TABLE monthly_rollups LIKE {}.monthly_rollups; "\
+	      "CREATE TABLE report_snapshots LIKE {}.report_snapshots; "\
+	      "CREATE TABLE data_version LIKE {}.data_version; "\
+	      "INSERT INTO data_version VALUES (1, 0); "\
+	      "CREATE TABLE data_changes LIKE {}.data_changes; "\
 	      .format(test_db_name, test_db_name, test_db_name, old_db_name,
-		      old_db_name, old_db_name, old_db_name, old_db_name)
+		      old_db_name, old_db_name, old_db_name, old_db_name,
+		      old_db_name, old_db_name, old_db_name, old_db_name,
+		      old_db_name)
 	yield tx.execute(sql)
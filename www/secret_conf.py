@@ -3,9 +3,12 @@
 
 import json
 
+import tornado.gen
 from pbkdf2 import crypt
 from pbkdf2 import _makesalt as makesalt
 
+import application
+
 db_host = None
 db_user = None
 db_passwd = None
@@ -16,6 +19,17 @@ db_idle_seconds = 7200
 db_connection_timeout = 3
 db_charset = 'utf8'
 test_db_name = "test_volgograd"
+parse_workers = 2
+parse_use_processes = True
+parse_queue_size = 8
+parse_timeout = 60
+db_replicas = []
+replica_check_interval = 5
+read_your_writes_seconds = 10
+cache_poll_interval = 1
+hash_workers = 2
+hash_use_processes = True
+hash_queue_size = 32
 
 pepper = None
 
@@ -29,6 +43,29 @@ def check_password(password, salt, hashed_true):
 	hashed = crypt(password + pepper, salt)
 	return hashed_true == hashed
 
+##
+# Same as generate_password_hash(), but the hash is computed in the
+# hash executor without blocking the IOLoop.
+# @sa application.run_hash().
+#
+@tornado.gen.coroutine
+def generate_password_hash_async(password):
+	global pepper
+	salt = makesalt()
+	hashed = yield application.run_hash(crypt, password + pepper, salt)
+	return (salt, hashed)
+
+##
+# Same as check_password(), but the hash is computed in the hash
+# executor without blocking the IOLoop.
+# @sa application.run_hash().
+#
+@tornado.gen.coroutine
+def check_password_async(password, salt, hashed_true):
+	global pepper
+	hashed = yield application.run_hash(crypt, password + pepper, salt)
+	return hashed_true == hashed
+
 def parse_config():
 	with open('secret_conf.json') as data:
 		conf = json.load(data)
@@ -37,6 +74,22 @@ def parse_config():
 		global db_passwd
 		global cookie_secret
 		global pepper
+		global max_db_connections
+		global db_idle_seconds
+		global db_connection_timeout
+		global db_charset
+		global test_db_name
+		global parse_workers
+		global parse_use_processes
+		global parse_queue_size
+		global parse_timeout
+		global db_replicas
+		global replica_check_interval
+		global read_your_writes_seconds
+		global cache_poll_interval
+		global hash_workers
+		global hash_use_processes
+		global hash_queue_size
 		db_host = conf['db_host']
 		db_user = conf['db_user']
 		db_passwd = conf['db_passwd']
@@ -52,3 +105,25 @@ def parse_config():
 			db_charset = conf['db_charset']
 		if 'test_db_name' in conf:
 			test_db_name = conf['test_db_name']
+		if 'parse_workers' in conf:
+			parse_workers = conf['parse_workers']
+		if 'parse_use_processes' in conf:
+			parse_use_processes = conf['parse_use_processes']
+		if 'parse_queue_size' in conf:
+			parse_queue_size = conf['parse_queue_size']
+		if 'parse_timeout' in conf:
+			parse_timeout = conf['parse_timeout']
+		if 'db_replicas' in conf:
+			db_replicas = conf['db_replicas']
+		if 'replica_check_interval' in conf:
+			replica_check_interval = conf['replica_check_interval']
+		if 'read_your_writes_seconds' in conf:
+			read_your_writes_seconds = conf['read_your_writes_seconds']
+		if 'cache_poll_interval' in conf:
+			cache_poll_interval = conf['cache_poll_interval']
+		if 'hash_workers' in conf:
+			hash_workers = conf['hash_workers']
+		if 'hash_use_processes' in conf:
+			hash_use_processes = conf['hash_use_processes']
+		if 'hash_queue_size' in conf:
+			hash_queue_size = conf['hash_queue_size']
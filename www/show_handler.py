@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import zlib
+import functools
 import application
+import cache
 import calendar
-from datetime import date
+from datetime import date, datetime
 
 import tornado
 import tornado.web
@@ -13,6 +16,73 @@ from query import *
 from constants import *
 from base_handler import BaseHandler, need_rights
 
+##
+# Version of the report_rooms.html snapshots. Must be incremented on
+# each change of the template or of its arguments, then the old
+# snapshots are rendered again on the next view.
+#
+REPORT_SNAPSHOT_VERSION = 1
+
+##
+# Build months table of the calendar. i-th element - array of i-th
+# month with specified report date if it was found in reports table.
+# The result depends only on the arguments, so it is cached. It must
+# not be modified.
+# @param year          Year of the calendar.
+# @param uploaded_days Bitmap of the report dates.
+#                      @sa cache.ReportDatesCache.
+#
+@functools.lru_cache(maxsize=64)
+def get_calendar_months(year, uploaded_days):
+	months = []
+	day_bit = 1
+	for month_num in range(1, 13):
+		#
+		# Start week - number of the first day of
+		# the month in the week: 0 - 6 = from
+		# monday to sunday.
+		#
+		start_week, days_count =\
+			calendar.monthrange(year, month_num)
+		month = []
+		day_iter = 1
+		#
+		# Weeks count - how many full weeks need
+		# to contain this month.
+		#
+		weeks_cnt = int((start_week + days_count) / 7)
+		if (start_week + days_count) % 7 != 0:
+			weeks_cnt += 1
+		for day in range(0, weeks_cnt * 7):
+			#
+			# If the day not in this month
+			# then skip it.
+			#
+			if start_week > day or day_iter > days_count:
+				month.append({'day_val': ''})
+				continue
+
+			#
+			# If the day from this month but
+			# a report for this day wasn't
+			# found then print only day.
+			#
+			if not uploaded_days & day_bit:
+				month.append({'day_val': day_iter})
+			else:
+				#
+				# Else generate the link to the
+				# report table.
+				#
+				month.append({'day_val': day_iter,
+					      'full_date':
+						get_str_date(year, month_num,
+							     day_iter)})
+			day_iter += 1
+			day_bit <<= 1
+		months.append(month)
+	return months
+
 ##
 # Choose date and show page with a report table on specified date.
 #
@@ -25,31 +95,19 @@ class ShowHandler(BaseHandler):
 	@need_rights(CAN_SEE_REPORTS)
 	def print_calendar(self, year):
 		assert(year > 1970)
-		uploaded_days_raw = []
 		#
-		# Find what reports were uploaded.
+		# Find what reports were uploaded. The database is
+		# accessed only on the first view of the year.
 		#
-		tx = None
 		try:
-			tx = yield application.begin()
-			uploaded_days_raw = yield get_report_dates_by_year(tx,
-									   year)
+			uploaded_days = yield cache.report_dates.load(
+				application.reader, year)
 		except Exception:
 			logger.exception('Error with getting report dates by '\
 					 'year')
-			self.rollback_error(tx, e_hdr=ERR_500,
-					    e_msg='Не удалось загрузить год')
+			self.render_error(e_hdr=ERR_500,
+					  e_msg='Не удалось загрузить год')
 			return
-		yield tx.commit()
-		uploaded_days = {}
-		#
-		# Group days by months.
-		#
-		for month, day in uploaded_days_raw:
-			if month in uploaded_days:
-				uploaded_days[month] |= {day}
-			else:
-				uploaded_days[month] = set([day, ])
 		#
 		# If not reports for the specified year then
 		# render the error page - nothing to show.
@@ -61,61 +119,68 @@ class ShowHandler(BaseHandler):
 					  template='choose_day_year_error.html',
 					  year=year)
 			return
-		months = []
-		#
-		# Build months table. i-th element - array of i-th
-		# month with specified report date if it was found
-		# in reports table.
-		#
-		for month_num in range(1, 13):
-			#
-			# Start week - number of the first day of
-			# the month in the week: 0 - 6 = from
-			# monday to sunday.
-			#
-			start_week, days_count =\
-				calendar.monthrange(year, month_num)
-			month = []
-			day_iter = 1
-			#
-			# Weeks count - how many full weeks need
-			# to contain this month.
-			#
-			weeks_cnt = int((start_week + days_count) / 7)
-			if (start_week + days_count) % 7 != 0:
-				weeks_cnt += 1
-			for day in range(0, weeks_cnt * 7):
-				#
-				# If the day not in this month
-				# then skip it.
-				#
-				if start_week > day or day_iter > days_count:
-					month.append({'day_val': ''})
-					continue
-
-				#
-				# If the day from this month but
-				# a report for this day wasn't
-				# found then print only day.
-				#
-				if month_num not in uploaded_days or\
-				   day_iter not in uploaded_days[month_num]:
-					month.append({'day_val': day_iter})
-					day_iter += 1
-					continue
-				#
-				# Else generate the link to the
-				# report table.
-				#
-				month.append({'day_val': day_iter,
-					      'full_date':
-						get_str_date(year, month_num,
-							     day_iter)})
-				day_iter += 1
-			months.append(month)
+		months = get_calendar_months(year, uploaded_days)
 		self.render('choose_day.html', months=months,
 			    month_names=month_names, year=year)
 
+	##
+	# Load the report with the rendered table of the boiler room
+	# reports. The table does not depend on the user, so it is
+	# rendered once, on the first view, and is stored compressed in
+	# the database. The snapshot is deleted together with the
+	# report.
+	# @param tx   Current transaction or application.reader.
+	# @param date Date of the report, datetime.date.
+	#
+	# @retval     None The report is not found.
+	# @retval not None Dictionary with the report attributes and
+	#                  'rooms_html' - the rendered table.
+	#
+	@tornado.gen.coroutine
+	def load_report(self, tx, date):
+		str_date = date.strftime(date_format)
+		report = yield get_report_header_by_date(tx, str_date)
+		if not report:
+			return None
+		html = yield get_report_snapshot(tx, report['id'],
+						 REPORT_SNAPSHOT_VERSION)
+		if html is not None:
+			report['rooms_html'] = zlib.decompress(html)
+			return report
+		#
+		# The report could be replaced after the previous query,
+		# so the attributes are taken from the full report too.
+		#
+		full_report = yield get_full_report_by_date(tx, str_date)
+		if not full_report:
+			return None
+		rooms_html = self.render_string('report_rooms.html',
+						districts=full_report['districts'],
+						get_val=get_html_val)
+		del full_report['districts']
+		report = full_report
+		report['rooms_html'] = rooms_html
+		#
+		# The snapshot is only an optimization - the report is
+		# shown even if it can not be stored. It is written in
+		# an own transaction, because tx can be a reader.
+		#
+		write_tx = None
+		try:
+			write_tx = yield application.begin()
+			yield insert_report_snapshot(write_tx, report['id'],
+						     REPORT_SNAPSHOT_VERSION,
+						     zlib.compress(rooms_html))
+			yield write_tx.commit()
+		except Exception:
+			logger.exception('Error with storing report snapshot')
+			if write_tx:
+				try:
+					yield write_tx.rollback()
+				except Exception:
+					pass
+		return report
+
 	@tornado.gen.coroutine
 	@need_rights(CAN_SEE_REPORTS)
 	def get(self):
@@ -135,32 +200,38 @@ class ShowHandler(BaseHandler):
 						'положительным числом от 1970')
 			return
 		if not full_date:
+			if self.check_not_modified():
+				return
 			yield self.print_calendar(year)
 			return
-		tx = None
 		try:
-			tx = yield application.begin()
-			report = yield get_full_report_by_date(tx, full_date)
-			if not report:
-				self.rollback_error(tx, e_hdr=ERR_404,
-						    e_msg='Отчет за указанную '\
-						    	  'дату не найден')
-				return
-			yield tx.commit()
+			full_date = datetime.strptime(full_date, date_format).date()
+		except ValueError:
+			self.render_error(e_hdr=ERR_404,
+					  e_msg='Отчет за указанную дату не найден')
+			return
+		if self.check_not_modified():
+			return
+		report = cache.reports.get(full_date)
+		try:
+			if report is None:
+				version = cache.reports.version
+				report = yield self.load_report(application.reader,
+								full_date)
+				if not report:
+					self.render_error(e_hdr=ERR_404,
+							  e_msg='Отчет за '\
+								'указанную дату '\
+								'не найден')
+					return
+				cache.reports.put(full_date, report, version)
 		except Exception as e:
 			logger.exception("Error with full report getting")
-			if len(e.args) > 0 and e.args[0] == DUPLICATE_ERROR:
-				self.rollback_error(tx, e_hdr=ERR_INSERT,
-						    e_msg='Запись с таким '\
-							  'идентификатором уже'\
-							  ' существует')
-			else:
-				self.rollback_error(tx, e_hdr=ERR_500)
+			self.render_error(e_hdr=ERR_500)
 		else:
 			assert(self.current_user)
 			assert('rights' in self.current_user)
 			self.render('show_table.html', **report,
-				    get_val=get_html_val,
 				    get_date=get_str_date,
 				    wind_directions=wind_directions,
 				    CONFIRM_DELETE=CONFIRM_DELETE)
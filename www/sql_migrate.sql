@@ -0,0 +1,175 @@
+-- Upgrade of an existing database to the schema from sql_prepare.sql.
+-- Each block must be executed once, in the order of appearance.
+
+USE volgograd;
+
+-- Indexes for the date range and boiler room queries.
+ALTER TABLE reports ADD INDEX date_temp_average_air (date, temp_average_air);
+ALTER TABLE boiler_room_reports
+	ADD INDEX boiler_room_report (boiler_room_id, report_id);
+
+-- Daily and monthly rollups of boiler_room_reports.
+CREATE TABLE daily_rollups (date DATE PRIMARY KEY,
+	rooms_count INT UNSIGNED,
+	sum_T1 DOUBLE, avg_T1 DOUBLE,
+	sum_T2 DOUBLE, avg_T2 DOUBLE,
+	sum_gas_pressure DOUBLE, avg_gas_pressure DOUBLE,
+	sum_boilers_all DOUBLE, avg_boilers_all DOUBLE,
+	sum_boilers_in_use DOUBLE, avg_boilers_in_use DOUBLE,
+	sum_torchs_in_use DOUBLE, avg_torchs_in_use DOUBLE,
+	sum_boilers_reserve DOUBLE, avg_boilers_reserve DOUBLE,
+	sum_boilers_in_repair DOUBLE, avg_boilers_in_repair DOUBLE,
+	sum_net_pumps_in_work DOUBLE, avg_net_pumps_in_work DOUBLE,
+	sum_net_pumps_reserve DOUBLE, avg_net_pumps_reserve DOUBLE,
+	sum_net_pumps_in_repair DOUBLE, avg_net_pumps_in_repair DOUBLE,
+	sum_all_day_expected_temp1 DOUBLE, avg_all_day_expected_temp1 DOUBLE,
+	sum_all_day_expected_temp2 DOUBLE, avg_all_day_expected_temp2 DOUBLE,
+	sum_all_day_real_temp1 DOUBLE, avg_all_day_real_temp1 DOUBLE,
+	sum_all_day_real_temp2 DOUBLE, avg_all_day_real_temp2 DOUBLE,
+	sum_all_night_expected_temp1 DOUBLE, avg_all_night_expected_temp1 DOUBLE,
+	sum_all_night_expected_temp2 DOUBLE, avg_all_night_expected_temp2 DOUBLE,
+	sum_all_night_real_temp1 DOUBLE, avg_all_night_real_temp1 DOUBLE,
+	sum_all_night_real_temp2 DOUBLE, avg_all_night_real_temp2 DOUBLE,
+	sum_net_pressure1 DOUBLE, avg_net_pressure1 DOUBLE,
+	sum_net_pressure2 DOUBLE, avg_net_pressure2 DOUBLE,
+	sum_net_water_consum_expected_ph DOUBLE, avg_net_water_consum_expected_ph DOUBLE,
+	sum_net_water_consum_real_ph DOUBLE, avg_net_water_consum_real_ph DOUBLE,
+	sum_make_up_water_consum_expected_ph DOUBLE, avg_make_up_water_consum_expected_ph DOUBLE,
+	sum_make_up_water_consum_real_ph DOUBLE, avg_make_up_water_consum_real_ph DOUBLE,
+	sum_make_up_water_consum_real_pd DOUBLE, avg_make_up_water_consum_real_pd DOUBLE,
+	sum_make_up_water_consum_real_pm DOUBLE, avg_make_up_water_consum_real_pm DOUBLE,
+	sum_hardness DOUBLE, avg_hardness DOUBLE,
+	sum_transparency DOUBLE, avg_transparency DOUBLE
+	) CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+CREATE TABLE monthly_rollups (month DATE PRIMARY KEY,
+	days_count INT UNSIGNED,
+	rooms_count INT UNSIGNED,
+	sum_T1 DOUBLE, avg_T1 DOUBLE,
+	sum_T2 DOUBLE, avg_T2 DOUBLE,
+	sum_gas_pressure DOUBLE, avg_gas_pressure DOUBLE,
+	sum_boilers_all DOUBLE, avg_boilers_all DOUBLE,
+	sum_boilers_in_use DOUBLE, avg_boilers_in_use DOUBLE,
+	sum_torchs_in_use DOUBLE, avg_torchs_in_use DOUBLE,
+	sum_boilers_reserve DOUBLE, avg_boilers_reserve DOUBLE,
+	sum_boilers_in_repair DOUBLE, avg_boilers_in_repair DOUBLE,
+	sum_net_pumps_in_work DOUBLE, avg_net_pumps_in_work DOUBLE,
+	sum_net_pumps_reserve DOUBLE, avg_net_pumps_reserve DOUBLE,
+	sum_net_pumps_in_repair DOUBLE, avg_net_pumps_in_repair DOUBLE,
+	sum_all_day_expected_temp1 DOUBLE, avg_all_day_expected_temp1 DOUBLE,
+	sum_all_day_expected_temp2 DOUBLE, avg_all_day_expected_temp2 DOUBLE,
+	sum_all_day_real_temp1 DOUBLE, avg_all_day_real_temp1 DOUBLE,
+	sum_all_day_real_temp2 DOUBLE, avg_all_day_real_temp2 DOUBLE,
+	sum_all_night_expected_temp1 DOUBLE, avg_all_night_expected_temp1 DOUBLE,
+	sum_all_night_expected_temp2 DOUBLE, avg_all_night_expected_temp2 DOUBLE,
+	sum_all_night_real_temp1 DOUBLE, avg_all_night_real_temp1 DOUBLE,
+	sum_all_night_real_temp2 DOUBLE, avg_all_night_real_temp2 DOUBLE,
+	sum_net_pressure1 DOUBLE, avg_net_pressure1 DOUBLE,
+	sum_net_pressure2 DOUBLE, avg_net_pressure2 DOUBLE,
+	sum_net_water_consum_expected_ph DOUBLE, avg_net_water_consum_expected_ph DOUBLE,
+	sum_net_water_consum_real_ph DOUBLE, avg_net_water_consum_real_ph DOUBLE,
+	sum_make_up_water_consum_expected_ph DOUBLE, avg_make_up_water_consum_expected_ph DOUBLE,
+	sum_make_up_water_consum_real_ph DOUBLE, avg_make_up_water_consum_real_ph DOUBLE,
+	sum_make_up_water_consum_real_pd DOUBLE, avg_make_up_water_consum_real_pd DOUBLE,
+	sum_make_up_water_consum_real_pm DOUBLE, avg_make_up_water_consum_real_pm DOUBLE,
+	sum_hardness DOUBLE, avg_hardness DOUBLE,
+	sum_transparency DOUBLE, avg_transparency DOUBLE
+	) CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+INSERT INTO daily_rollups SELECT date, COUNT(*),
+	SUM(T1), AVG(T1),
+	SUM(T2), AVG(T2),
+	SUM(gas_pressure), AVG(gas_pressure),
+	SUM(boilers_all), AVG(boilers_all),
+	SUM(boilers_in_use), AVG(boilers_in_use),
+	SUM(torchs_in_use), AVG(torchs_in_use),
+	SUM(boilers_reserve), AVG(boilers_reserve),
+	SUM(boilers_in_repair), AVG(boilers_in_repair),
+	SUM(net_pumps_in_work), AVG(net_pumps_in_work),
+	SUM(net_pumps_reserve), AVG(net_pumps_reserve),
+	SUM(net_pumps_in_repair), AVG(net_pumps_in_repair),
+	SUM(all_day_expected_temp1), AVG(all_day_expected_temp1),
+	SUM(all_day_expected_temp2), AVG(all_day_expected_temp2),
+	SUM(all_day_real_temp1), AVG(all_day_real_temp1),
+	SUM(all_day_real_temp2), AVG(all_day_real_temp2),
+	SUM(all_night_expected_temp1), AVG(all_night_expected_temp1),
+	SUM(all_night_expected_temp2), AVG(all_night_expected_temp2),
+	SUM(all_night_real_temp1), AVG(all_night_real_temp1),
+	SUM(all_night_real_temp2), AVG(all_night_real_temp2),
+	SUM(net_pressure1), AVG(net_pressure1),
+	SUM(net_pressure2), AVG(net_pressure2),
+	SUM(net_water_consum_expected_ph), AVG(net_water_consum_expected_ph),
+	SUM(net_water_consum_real_ph), AVG(net_water_consum_real_ph),
+	SUM(make_up_water_consum_expected_ph), AVG(make_up_water_consum_expected_ph),
+	SUM(make_up_water_consum_real_ph), AVG(make_up_water_consum_real_ph),
+	SUM(make_up_water_consum_real_pd), AVG(make_up_water_consum_real_pd),
+	SUM(make_up_water_consum_real_pm), AVG(make_up_water_consum_real_pm),
+	SUM(hardness), AVG(hardness),
+	SUM(transparency), AVG(transparency)
+	FROM reports JOIN boiler_room_reports ON(reports.id = report_id)
+	GROUP BY date;
+INSERT INTO monthly_rollups SELECT DATE_FORMAT(date, '%Y-%m-01'),
+	COUNT(DISTINCT date), COUNT(*),
+	SUM(T1), AVG(T1),
+	SUM(T2), AVG(T2),
+	SUM(gas_pressure), AVG(gas_pressure),
+	SUM(boilers_all), AVG(boilers_all),
+	SUM(boilers_in_use), AVG(boilers_in_use),
+	SUM(torchs_in_use), AVG(torchs_in_use),
+	SUM(boilers_reserve), AVG(boilers_reserve),
+	SUM(boilers_in_repair), AVG(boilers_in_repair),
+	SUM(net_pumps_in_work), AVG(net_pumps_in_work),
+	SUM(net_pumps_reserve), AVG(net_pumps_reserve),
+	SUM(net_pumps_in_repair), AVG(net_pumps_in_repair),
+	SUM(all_day_expected_temp1), AVG(all_day_expected_temp1),
+	SUM(all_day_expected_temp2), AVG(all_day_expected_temp2),
+	SUM(all_day_real_temp1), AVG(all_day_real_temp1),
+	SUM(all_day_real_temp2), AVG(all_day_real_temp2),
+	SUM(all_night_expected_temp1), AVG(all_night_expected_temp1),
+	SUM(all_night_expected_temp2), AVG(all_night_expected_temp2),
+	SUM(all_night_real_temp1), AVG(all_night_real_temp1),
+	SUM(all_night_real_temp2), AVG(all_night_real_temp2),
+	SUM(net_pressure1), AVG(net_pressure1),
+	SUM(net_pressure2), AVG(net_pressure2),
+	SUM(net_water_consum_expected_ph), AVG(net_water_consum_expected_ph),
+	SUM(net_water_consum_real_ph), AVG(net_water_consum_real_ph),
+	SUM(make_up_water_consum_expected_ph), AVG(make_up_water_consum_expected_ph),
+	SUM(make_up_water_consum_real_ph), AVG(make_up_water_consum_real_ph),
+	SUM(make_up_water_consum_real_pd), AVG(make_up_water_consum_real_pd),
+	SUM(make_up_water_consum_real_pm), AVG(make_up_water_consum_real_pm),
+	SUM(hardness), AVG(hardness),
+	SUM(transparency), AVG(transparency)
+	FROM reports JOIN boiler_room_reports ON(reports.id = report_id)
+	GROUP BY DATE_FORMAT(date, '%Y-%m-01');
+
+-- Pre-rendered tables of the daily reports. Filled on the first view.
+CREATE TABLE report_snapshots (report_id INT UNSIGNED PRIMARY KEY,
+	version INT UNSIGNED,
+	html MEDIUMBLOB,
+	FOREIGN KEY (report_id) REFERENCES reports(id) ON DELETE CASCADE)
+	CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Version of the reports data and the log of its last changes. Used
+-- to keep the caches of several server processes coherent.
+CREATE TABLE data_version (id INT UNSIGNED PRIMARY KEY,
+	version BIGINT UNSIGNED NOT NULL);
+INSERT INTO data_version VALUES (1, 0);
+CREATE TABLE data_changes (version BIGINT UNSIGNED PRIMARY KEY,
+	date DATE,
+	report_exists BOOL,
+	new_dimensions BOOL);
+
+-- Versions of the users for the session tokens. Changes of the users
+-- are logged in data_changes to invalidate the sessions in all the
+-- server processes.
+ALTER TABLE users ADD version INT UNSIGNED NOT NULL DEFAULT 1;
+ALTER TABLE data_changes ADD user_id INT UNSIGNED;
+
+-- Time of the data changes for the Last-Modified header, the same in
+-- all the server processes.
+ALTER TABLE data_changes ADD modified DATETIME;
+
+-- Index for the keyset pagination of the users list. The name must be
+-- not longer than MAX_NAME_LENGTH from users_management.py.
+ALTER TABLE users MODIFY name VARCHAR(200),
+	ADD INDEX name_email_id (name, email, id);
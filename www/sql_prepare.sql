@@ -3,9 +3,11 @@ CREATE DATABASE volgograd;
 USE volgograd;
 
 CREATE TABLE users (id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
-	email VARCHAR(100), password TEXT, salt VARCHAR(20), name TEXT,
+	email VARCHAR(100), password TEXT, salt VARCHAR(20), name VARCHAR(200),
 	rights INT UNSIGNED,
-	UNIQUE (email))
+	version INT UNSIGNED NOT NULL DEFAULT 1,
+	UNIQUE (email),
+	INDEX name_email_id (name, email, id))
 	CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 CREATE TABLE reports (id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
@@ -25,7 +27,9 @@ CREATE TABLE reports (id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
 	forecast_temp_night_from DOUBLE,
 	forecast_temp_night_to DOUBLE,
 	FOREIGN KEY (author_id) REFERENCES users(id) ON DELETE SET NULL,
-	UNIQUE (date)) CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+	UNIQUE (date),
+	INDEX date_temp_average_air (date, temp_average_air))
+	CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 CREATE TABLE districts (id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
 	name TEXT,
@@ -64,6 +68,92 @@ CREATE TABLE boiler_room_reports(id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
 	make_up_water_consum_real_pm DOUBLE,
 	hardness DOUBLE,
 	transparency DOUBLE,
+	INDEX boiler_room_report (boiler_room_id, report_id),
 	FOREIGN KEY (boiler_room_id) REFERENCES boiler_rooms(id) ON DELETE CASCADE,
 	FOREIGN KEY (report_id) REFERENCES reports(id) ON DELETE CASCADE)
 	CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+CREATE TABLE daily_rollups (date DATE PRIMARY KEY,
+	rooms_count INT UNSIGNED,
+	sum_T1 DOUBLE, avg_T1 DOUBLE,
+	sum_T2 DOUBLE, avg_T2 DOUBLE,
+	sum_gas_pressure DOUBLE, avg_gas_pressure DOUBLE,
+	sum_boilers_all DOUBLE, avg_boilers_all DOUBLE,
+	sum_boilers_in_use DOUBLE, avg_boilers_in_use DOUBLE,
+	sum_torchs_in_use DOUBLE, avg_torchs_in_use DOUBLE,
+	sum_boilers_reserve DOUBLE, avg_boilers_reserve DOUBLE,
+	sum_boilers_in_repair DOUBLE, avg_boilers_in_repair DOUBLE,
+	sum_net_pumps_in_work DOUBLE, avg_net_pumps_in_work DOUBLE,
+	sum_net_pumps_reserve DOUBLE, avg_net_pumps_reserve DOUBLE,
+	sum_net_pumps_in_repair DOUBLE, avg_net_pumps_in_repair DOUBLE,
+	sum_all_day_expected_temp1 DOUBLE, avg_all_day_expected_temp1 DOUBLE,
+	sum_all_day_expected_temp2 DOUBLE, avg_all_day_expected_temp2 DOUBLE,
+	sum_all_day_real_temp1 DOUBLE, avg_all_day_real_temp1 DOUBLE,
+	sum_all_day_real_temp2 DOUBLE, avg_all_day_real_temp2 DOUBLE,
+	sum_all_night_expected_temp1 DOUBLE, avg_all_night_expected_temp1 DOUBLE,
+	sum_all_night_expected_temp2 DOUBLE, avg_all_night_expected_temp2 DOUBLE,
+	sum_all_night_real_temp1 DOUBLE, avg_all_night_real_temp1 DOUBLE,
+	sum_all_night_real_temp2 DOUBLE, avg_all_night_real_temp2 DOUBLE,
+	sum_net_pressure1 DOUBLE, avg_net_pressure1 DOUBLE,
+	sum_net_pressure2 DOUBLE, avg_net_pressure2 DOUBLE,
+	sum_net_water_consum_expected_ph DOUBLE, avg_net_water_consum_expected_ph DOUBLE,
+	sum_net_water_consum_real_ph DOUBLE, avg_net_water_consum_real_ph DOUBLE,
+	sum_make_up_water_consum_expected_ph DOUBLE, avg_make_up_water_consum_expected_ph DOUBLE,
+	sum_make_up_water_consum_real_ph DOUBLE, avg_make_up_water_consum_real_ph DOUBLE,
+	sum_make_up_water_consum_real_pd DOUBLE, avg_make_up_water_consum_real_pd DOUBLE,
+	sum_make_up_water_consum_real_pm DOUBLE, avg_make_up_water_consum_real_pm DOUBLE,
+	sum_hardness DOUBLE, avg_hardness DOUBLE,
+	sum_transparency DOUBLE, avg_transparency DOUBLE
+	) CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+CREATE TABLE monthly_rollups (month DATE PRIMARY KEY,
+	days_count INT UNSIGNED,
+	rooms_count INT UNSIGNED,
+	sum_T1 DOUBLE, avg_T1 DOUBLE,
+	sum_T2 DOUBLE, avg_T2 DOUBLE,
+	sum_gas_pressure DOUBLE, avg_gas_pressure DOUBLE,
+	sum_boilers_all DOUBLE, avg_boilers_all DOUBLE,
+	sum_boilers_in_use DOUBLE, avg_boilers_in_use DOUBLE,
+	sum_torchs_in_use DOUBLE, avg_torchs_in_use DOUBLE,
+	sum_boilers_reserve DOUBLE, avg_boilers_reserve DOUBLE,
+	sum_boilers_in_repair DOUBLE, avg_boilers_in_repair DOUBLE,
+	sum_net_pumps_in_work DOUBLE, avg_net_pumps_in_work DOUBLE,
+	sum_net_pumps_reserve DOUBLE, avg_net_pumps_reserve DOUBLE,
+	sum_net_pumps_in_repair DOUBLE, avg_net_pumps_in_repair DOUBLE,
+	sum_all_day_expected_temp1 DOUBLE, avg_all_day_expected_temp1 DOUBLE,
+	sum_all_day_expected_temp2 DOUBLE, avg_all_day_expected_temp2 DOUBLE,
+	sum_all_day_real_temp1 DOUBLE, avg_all_day_real_temp1 DOUBLE,
+	sum_all_day_real_temp2 DOUBLE, avg_all_day_real_temp2 DOUBLE,
+	sum_all_night_expected_temp1 DOUBLE, avg_all_night_expected_temp1 DOUBLE,
+	sum_all_night_expected_temp2 DOUBLE, avg_all_night_expected_temp2 DOUBLE,
+	sum_all_night_real_temp1 DOUBLE, avg_all_night_real_temp1 DOUBLE,
+	sum_all_night_real_temp2 DOUBLE, avg_all_night_real_temp2 DOUBLE,
+	sum_net_pressure1 DOUBLE, avg_net_pressure1 DOUBLE,
+	sum_net_pressure2 DOUBLE, avg_net_pressure2 DOUBLE,
+	sum_net_water_consum_expected_ph DOUBLE, avg_net_water_consum_expected_ph DOUBLE,
+	sum_net_water_consum_real_ph DOUBLE, avg_net_water_consum_real_ph DOUBLE,
+	sum_make_up_water_consum_expected_ph DOUBLE, avg_make_up_water_consum_expected_ph DOUBLE,
+	sum_make_up_water_consum_real_ph DOUBLE, avg_make_up_water_consum_real_ph DOUBLE,
+	sum_make_up_water_consum_real_pd DOUBLE, avg_make_up_water_consum_real_pd DOUBLE,
+	sum_make_up_water_consum_real_pm DOUBLE, avg_make_up_water_consum_real_pm DOUBLE,
+	sum_hardness DOUBLE, avg_hardness DOUBLE,
+	sum_transparency DOUBLE, avg_transparency DOUBLE
+	) CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+CREATE TABLE report_snapshots (report_id INT UNSIGNED PRIMARY KEY,
+	version INT UNSIGNED,
+	html MEDIUMBLOB,
+	FOREIGN KEY (report_id) REFERENCES reports(id) ON DELETE CASCADE)
+	CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+CREATE TABLE data_version (id INT UNSIGNED PRIMARY KEY,
+	version BIGINT UNSIGNED NOT NULL);
+
+INSERT INTO data_version VALUES (1, 0);
+
+CREATE TABLE data_changes (version BIGINT UNSIGNED PRIMARY KEY,
+	date DATE,
+	report_exists BOOL,
+	new_dimensions BOOL,
+	user_id INT UNSIGNED,
+	modified DATETIME);
@@ -16,3 +16,34 @@ function string_fixed_width(value, need_width) {
 	for (var i = 0; i < padding; ++i) spaces += ' ';
 	return spaces + str + spaces;
 };
+
+/**
+ * Decode a series, received from a plot endpoint in the 'dense' or
+ * 'delta' format, into the object { day: value }. Days without a
+ * value are absent in the result. The sparse variant of the formats
+ * has the list of days instead of the first day.
+ */
+function decode_series(series) {
+	var res = {};
+	var i;
+	var get_day = function(i) {
+		if ('days' in series)
+			return series.days[i];
+		return series.start + i;
+	};
+	if ('deltas' in series) {
+		var val = 0;
+		for (i = 0; i < series.deltas.length; ++i) {
+			if (series.deltas[i] == null)
+				continue;
+			val += series.deltas[i];
+			res[get_day(i)] = val / series.scale;
+		}
+		return res;
+	}
+	for (i = 0; i < series.values.length; ++i) {
+		if (series.values[i] != null)
+			res[get_day(i)] = series.values[i];
+	}
+	return res;
+};
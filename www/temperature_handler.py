@@ -8,6 +8,7 @@ import tornado.web
 import tornado.gen
 
 import application
+import cache
 from query import *
 from constants import *
 from base_handler import BaseHandler, need_rights
@@ -45,9 +46,7 @@ class TemperatureHandler(BaseHandler):
 					  e_msg='Год и месяц должны быть '\
 						'положительными числами')
 			return
-		tx = None
 		try:
-			tx = yield application.begin()
 			#
 			# We don't need to render a first
 			# parameter, because it will be requested
@@ -62,16 +61,15 @@ class TemperatureHandler(BaseHandler):
 			# So we need to pass only boiler and
 			# parameter identifiers.
 			#
-			districts = yield get_districts_with_boilers(tx)
-			start_week, days_count =\
-				calendar.monthrange(year, month)
-			self.render("temperature.html", year=year,
-				    days_count=days_count, districts=districts,
-				    month_names=month_names, month=month,
-				    get_date=get_str_date, get_val=get_html_val)
-			tx.commit()
+			districts = yield cache.dimensions.get_districts_with_boilers(
+				application.reader)
 		except:
 			logger.exception('Error with getting districts and '\
 					 'boilers')
-			self.rollback_error(tx, e_hdr=ERR_500)
+			self.render_error(e_hdr=ERR_500)
 			return
+		start_week, days_count = calendar.monthrange(year, month)
+		self.render("temperature.html", year=year,
+			    days_count=days_count, districts=districts,
+			    month_names=month_names, month=month,
+			    get_date=get_str_date, get_val=get_html_val)
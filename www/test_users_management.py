@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import re
 import urllib
 
 import tornado.testing
@@ -288,9 +289,12 @@ class TestSuiteUsersManagement(BaseTestSuite):
 			self.assertIn('<td>%s</td>' % user['email'], body)
 		logger.info('ok - first page of users list')
 		#
-		# Try to get the second page.
+		# Try to get the second page by the link from the
+		# first one.
 		#
-		url = '%s?page=2' % self.get_url('/users_management')
+		link = re.search('href="(/users_management\\?after=[^"]+)"',
+				 body).group(1)
+		url = self.get_url(link)
 		response = yield client.fetch(url, headers=headers,
 					      method='GET')
 		body = response.body.decode('utf-8')
@@ -306,17 +310,41 @@ class TestSuiteUsersManagement(BaseTestSuite):
 			self.assertIn('<td>%s</td>' % user['email'], body)
 		logger.info('ok - second page of users list')
 		#
+		# Go back to the first page.
+		#
+		link = re.search('href="(/users_management\\?before=[^"]+)"',
+				 body).group(1)
+		url = self.get_url(link)
+		response = yield client.fetch(url, headers=headers,
+					      method='GET')
+		body = response.body.decode('utf-8')
+		self.assertIn('Вперед <span aria-hidden="true">&rarr;</span>',
+			      body)
+		self.assertNotIn('<span aria-hidden="true">&larr;</span> Назад',
+				 body)
+		for i, user in enumerate(all_inserted):
+			if i >= USERS_ON_PAGE:
+				break;
+			self.assertIn('<td>%s</td>' % user['email'], body)
+		logger.info('ok - previous page of users list')
+		#
 		# Get incorrect page.
 		#
+		last = all_inserted[-1]
+		after_last = encode_cursor({ 'name': last['name'] or None,
+					     'email': last['email'],
+					     'id': 1000 })
 		url = self.get_url('/users_management')
-		urls = [ '%s?page=-1' % url, '%s?page=abc' % url,
-			 '%s?page=1000' % url ]
+		urls = [ '%s?after=-1' % url, '%s?before=abc' % url,
+			 '%s?after=%s' % (url, after_last),
+			 '%s?after=%s&before=%s' % (url, after_last,
+						    after_last) ]
 		for url in urls:
 			response = yield client.fetch(url, headers=headers,
 						      method='GET')
 			body = response.body.decode('utf-8')
-			self.assertIn(ERR_PAGE_NUMBER, body)
-		logger.info('ok - incorrect page numbers')
+			self.assertIn(ERR_PAGE, body)
+		logger.info('ok - incorrect pages')
 		#
 		# Make incorrect action.
 		#
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from io import BytesIO
 from datetime import datetime
 from zipfile import BadZipFile
 
@@ -10,8 +9,9 @@ import tornado.web
 import tornado.gen
 
 import application
-from xml_parser import parse_xls, XLSCellEqualError, XLSCellInError,\
-		       XLSTypeError
+import cache
+from xml_parser import parse_xls_content, XLSCellEqualError,\
+		       XLSCellInError, XLSTypeError
 from base_handler import BaseHandler, need_rights
 from query import *
 from constants import *
@@ -28,108 +28,39 @@ class UploadHandler(BaseHandler):
 		self.render('upload_xls.html')
 
 	##
-	# Upload to the database the boiler room.
-	# @param tx   Transaction.
-	# @param r_id Report identifier.
-	# @param d_id District identifier.
-	# @param room Map with the boiler room attributes.
-	#
-	@tornado.gen.coroutine
-	def upload_room(self, tx, r_id, d_id, room):
-		name = room['name']
-		cols = ['id', ]
-		room_id = yield get_boiler_room_by_dist_and_name(tx, cols, d_id,
-								 name)
-		if not room_id:
-			yield insert_boiler_room(tx, d_id, name)
-			room_id =\
-				yield get_boiler_room_by_dist_and_name(tx, cols,
-								       d_id,
-								       name)
-		assert(room_id)
-		room_id = room_id[0]
-		yield insert_boiler_room_report(tx, room, room_id, r_id)
-
-	##
-	# Upload to the database the district itself and all its boiler rooms.
-	# @param tx       Transaction.
-	# @param r_id     Report identifier.
-	# @param district Map with the district name and rooms.
+	# Parse the uploaded file. No database connection is held
+	# during parsing. On an error the error page is rendered.
+	# @param body Content of the uploaded file.
 	#
-	@tornado.gen.coroutine
-	def upload_district(self, tx, r_id, district):
-		name = district['name']
-		#
-		# Try to find the district. If not found then
-		# first insert it to the database.
-		#
-		dist_id = yield get_district_by_name(tx, name, ['id', ])
-		if not dist_id:
-			yield insert_district(tx, name)
-			dist_id = yield get_district_by_name(tx, name, ['id', ])
-		assert(dist_id)
-		#
-		# get_... returns the entire district in which
-		# first element is 'id' column.
-		#
-		dist_id = dist_id[0]
-
-		for room in district['rooms']:
-			yield self.upload_room(tx, r_id, dist_id, room)
-
-	##
-	# Upload the report to the database.
+	# @retval     None Error, already rendered.
+	# @retval not None Dictionary with the parsed report.
 	#
 	@tornado.gen.coroutine
-	@need_rights(CAN_UPLOAD_REPORTS)
-	def post(self):
-		if 'xls-table' not in self.request.files:
-			self.render_error(e_hdr=ERR_UPLOAD,
-					  e_msg='Не указан файл')
-			return
-		fileinfo = self.request.files['xls-table'][0]
-		tx = None
+	def parse_report(self, body):
 		try:
-			tx = yield application.begin()
-			#
-			# We emulate a file by BytesIO usage.
-			#
-			data = parse_xls(BytesIO(fileinfo['body']))
-			#
-			# Start a transaction. Commit only if all is good
-			#
-			yield insert_report(tx, self.current_user['user_id'],
-					    data)
 			#
-			# Get the inserted report id for creating foreign key to
-			# it in other tables.
+			# Parse in the executor to keep the server
+			# responsive for other requests.
 			#
-			report_id = yield get_report_by_date(tx, data['date'],
-							     ['id', ])
-			assert(report_id)
-			#
-			# get_... returns the entire report in which first
-			# element is 'id' column.
-			#
-			report_id = report_id[0]
-
-			for district in data['districts']:
-				yield self.upload_district(tx, report_id,
-							   district)
-			#
-			# Get date in dd.mm.yyyy format
-			date = data['date']
-			# Create datetime python object
-			date = datetime.strptime(date, date_format)
-			# Convert it to the format yyyy-mm-dd as in mysql
-			# database.
-			date = date.strftime(date_format)
-			self.redirect('/show_table?date={}'.format(date))
+			data = yield application.run_parse(parse_xls_content,
+							   body)
+			return data
 		except BadZipFile:
 			logger.exception("Unsupported file type")
-			self.rollback_error(tx, e_hdr=ERR_INSERT,
-					    e_msg='Файл имеет неподдерживаемый'\
-						  ' формат')
+			self.render_error(e_hdr=ERR_INSERT,
+					  e_msg='Файл имеет неподдерживаемый'\
+						' формат')
+		except ExecutorBusyError:
+			logger.error("Too many reports are being parsed")
+			self.render_error(e_hdr=ERR_UPLOAD,
+					  e_msg='Сервер занят обработкой других '\
+						'отчетов, повторите попытку '\
+						'позже')
+		except tornado.gen.TimeoutError:
+			logger.error("Report parsing timed out")
+			self.render_error(e_hdr=ERR_UPLOAD,
+					  e_msg='Превышено время обработки '\
+						'файла')
 		except XLSTypeError as e:
 			logger.exception("Type error")
 			str_type = e.expected
@@ -140,20 +71,133 @@ class UploadHandler(BaseHandler):
 			msg = 'Ошибка в типе значения в строке {}, столбце {}:'\
 			      ' ожидался тип {}, а получено значение: {}'\
 			      .format(e.row, e.column, str_type, e.real)
-			self.rollback_error(tx, e_hdr=ERR_INSERT, e_msg=msg)
+			self.render_error(e_hdr=ERR_INSERT, e_msg=msg)
 		except XLSCellEqualError as e:
 			logger.exception("One of values in report is incorrect")
 			msg = 'Ошибка в строке {}, столбце {}: ожидалось '\
 			      'значение "{}", однако встречено "{}"'\
 			      .format(e.row, e.column, e.expected, e.real)
-			self.rollback_error(tx, e_hdr=ERR_INSERT, e_msg=msg)
+			self.render_error(e_hdr=ERR_INSERT, e_msg=msg)
 		except XLSCellInError as e:
 			logger.exception("One of values in report is incorrect")
-			words = ', '.join(['"{}"' % val for val in e.expected])
+			words = ', '.join(['"{}"'.format(val)
+					   for val in e.expected])
 			msg = 'Ошибка в строке {}, столбце {}: в ячейке '\
 			      'ожидались слова {}, однако встречено {}'\
 			      .format(e.row, e.column, words, e.real)
-			self.rollback_error(tx, e_hdr=ERR_INSERT, e_msg=msg)
+			self.render_error(e_hdr=ERR_INSERT, e_msg=msg)
+		except Exception:
+			logger.exception("Error with parsing report")
+			self.render_error(e_hdr=ERR_500)
+		return None
+
+	##
+	# Check that the parsed report can be inserted into the
+	# database.
+	# @param data Dictionary with the parsed report.
+	#
+	# @retval     None The report is correct.
+	# @retval not None Error message.
+	#
+	def check_report(self, data):
+		try:
+			datetime.strptime(data['date'], date_format)
+		except (KeyError, TypeError, ValueError):
+			return 'Некорректная дата отчета: {}'\
+			       .format(get_safe_val(data, 'date'))
+		if not data['districts']:
+			return 'В отчете не найдено ни одного района'
+		for district in data['districts']:
+			for room in district['rooms']:
+				if not room['name']:
+					return 'В районе "{}" не указано '\
+					       'название котельной'\
+					       .format(district['name'])
+		return None
+
+	##
+	# Insert the parsed report with all its districts and boiler
+	# rooms.
+	# @param tx   Transaction.
+	# @param data Dictionary with the parsed report.
+	#
+	# @retval Tuple (version of the data change, true if new
+	#         districts or boiler rooms were inserted).
+	#
+	@tornado.gen.coroutine
+	def write_report(self, tx, data):
+		report_id = yield insert_report(tx,
+						self.current_user['user_id'],
+						data)
+		assert(report_id)
+		#
+		# Resolve districts and boiler rooms by the cache. The
+		# missed ones are inserted and remembered locally - the
+		# cache can be updated only after commit. A missed name
+		# can be equal to an existing one by the collation, then
+		# the insert returns the existing identifier.
+		#
+		dist_ids, room_ids = yield cache.dimensions.get_ids(tx)
+		new_dist_ids = {}
+		new_room_ids = {}
+		reports = []
+		for district in data['districts']:
+			key = get_name_key(district['name'])
+			d_id = dist_ids.get(key, new_dist_ids.get(key))
+			if not d_id:
+				d_id = yield insert_district(tx,
+							     district['name'])
+				new_dist_ids[key] = d_id
+			for room in district['rooms']:
+				key = (d_id, get_name_key(room['name']))
+				room_id = room_ids.get(key,
+						       new_room_ids.get(key))
+				if not room_id:
+					room_id = yield insert_boiler_room(tx,
+						d_id, room['name'])
+					new_room_ids[key] = room_id
+				reports.append((room_id, room))
+		yield insert_boiler_room_reports(tx, report_id, reports)
+		date = datetime.strptime(data['date'], date_format).date()
+		yield update_rollups(tx, date)
+		new_dimensions = len(new_dist_ids) > 0 or len(new_room_ids) > 0
+		version = yield insert_data_change(tx, date, True,
+						   new_dimensions)
+		return (version, new_dimensions)
+
+	##
+	# Upload the report to the database. The work is done in
+	# three steps: parse, validate and write. A database
+	# connection is taken only for the last one.
+	#
+	@tornado.gen.coroutine
+	@need_rights(CAN_UPLOAD_REPORTS)
+	def post(self):
+		if 'xls-table' not in self.request.files:
+			self.render_error(e_hdr=ERR_UPLOAD,
+					  e_msg='Не указан файл')
+			return
+		fileinfo = self.request.files['xls-table'][0]
+		data = yield self.parse_report(fileinfo['body'])
+		if data is None:
+			return
+		msg = self.check_report(data)
+		if msg:
+			self.render_error(e_hdr=ERR_INSERT, e_msg=msg)
+			return
+		tx = None
+		try:
+			#
+			# Start a transaction. Commit only if all is good
+			#
+			tx = yield application.begin()
+			version, new_dimensions = yield self.write_report(tx,
+									 data)
+			yield tx.commit()
+			date = datetime.strptime(data['date'], date_format)
+			cache.changes.data_changed(version, date.date(), True,
+						   new_dimensions)
+			self.mark_written()
 		except Exception as e:
 			if len(e.args) > 0 and e.args[0] == DUPLICATE_ERROR:
 				self.rollback_error(tx,
@@ -161,8 +205,19 @@ class UploadHandler(BaseHandler):
 						    e_msg='Запись с таким '\
 						    	  'идентификатором уже'\
 							  ' существует')
+			elif isinstance(e, NameCollisionError):
+				self.rollback_error(tx, e_hdr=ERR_INSERT,
+						    e_msg=str(e))
 			else:
 				logger.exception("Error with uploading report")
 				self.rollback_error(tx, e_hdr=ERR_500)
-		else:
-			yield tx.commit()
+			return
+		#
+		# Get date in dd.mm.yyyy format
+		date = data['date']
+		# Create datetime python object
+		date = datetime.strptime(date, date_format)
+		# Convert it to the format yyyy-mm-dd as in mysql
+		# database.
+		date = date.strftime(date_format)
+		self.redirect('/show_table?date={}'.format(date))
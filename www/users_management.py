@@ -2,17 +2,20 @@
 # -*- coding: utf-8 -*-
 
 import re
+import json
+import base64
 
 import tornado
 import tornado.gen
 
 import secret_conf as sc
 import application
+import cache
 from base_handler import BaseHandler, need_rights
 from constants import *
 from query import *
 
-ERR_PAGE_NUMBER = 'Ошибка в указании номера страницы.'
+ERR_PAGE = 'Ошибка в указании страницы.'
 ERR_USER_ACTION_ID = 'Ошибка в указании идентификатора пользователя. '\
 		     'Идентификатор должен быть целым неотрицательным числом'
 ERR_ACTION = 'Ошибка при выборе действия'
@@ -59,6 +62,38 @@ users_management_params = {
 	'password_match_err' : ERR_PASSWORD_MATCH
 }
 
+##
+# Encode the position of the user in the users list for the page
+# links. @sa get_users_page().
+# @param user Dictionary with 'name', 'email' and 'id'.
+#
+# @retval String, safe for an URL.
+#
+def encode_cursor(user):
+	value = json.dumps([user['name'], user['email'], user['id']])
+	value = base64.urlsafe_b64encode(value.encode('utf-8'))
+	return value.decode('ascii').rstrip('=')
+
+##
+# Decode the position of the user in the users list.
+# @param value String from encode_cursor().
+#
+# @retval     None The value is incorrect.
+# @retval not None Tuple (name, email, id).
+#
+def decode_cursor(value):
+	try:
+		value = value + '=' * (-len(value) % 4)
+		value = base64.urlsafe_b64decode(value.encode('ascii'))
+		name, email, id = json.loads(value.decode('utf-8'))
+	except (ValueError, TypeError):
+		return None
+	if name is not None and not isinstance(name, str):
+		return None
+	if not isinstance(email, str) or not isinstance(id, int):
+		return None
+	return (name, email, id)
+
 ##
 # Handler to show the site users, its rights, names, emails.
 # Also you can create new users, delete and edit existing.
@@ -73,45 +108,80 @@ class UsersManagementHandler(BaseHandler):
 	#               then on next page we need to show message
 	#               about deletion status and remained users.
 	#
+	# @retval True  The transaction is committed.
+	# @retval False The transaction is rolled back.
+	#
 	@tornado.gen.coroutine
 	@need_rights(CAN_EDIT_USERS | CAN_SEE_USERS)
 	def render_page_and_commit(self, tx, **kwargs):
-		page = self.get_argument('page', 1)
-		try:
-			page = int(page)
-			if page <= 0:
-				raise ValueError('Page must be positive '\
-						 'number.')
-		except:
-			self.rollback_error(tx, ERR_PARAMETERS, ERR_PAGE_NUMBER)
-			return
+		#
+		# The page is specified by the user after which it
+		# starts or before which it ends.
+		#
+		after = self.get_argument('after', None)
+		before = self.get_argument('before', None)
+		if after is not None and before is not None:
+			self.rollback_error(tx, ERR_PARAMETERS, ERR_PAGE)
+			return False
+		backward = before is not None
+		page_query = ''
+		cursor = None
+		position = before if backward else after
+		if position is not None:
+			cursor = decode_cursor(position)
+			if cursor is None:
+				self.rollback_error(tx, ERR_PARAMETERS, ERR_PAGE)
+				return False
+			#
+			# Encode the cursor again to not render the
+			# raw argument.
+			#
+			name, email, id = cursor
+			position = encode_cursor({ 'name': name, 'email': email,
+						   'id': id })
+			page_query = '{}={}'.format('before' if backward
+						    else 'after', position)
 		try:
 			#
 			# Fetch one more user than need, to check
-			# if we are showing the last page.
+			# if there are users in the direction of the
+			# page.
 			#
 			limit = USERS_ON_PAGE + 1
-			offset = (page - 1) * USERS_ON_PAGE
 			columns = ['id', 'email', 'name', 'rights']
-			users = yield get_users_range(tx, limit, offset,
-						      columns)
+			users = yield get_users_page(tx, columns, limit,
+						     cursor, backward)
 			count = len(users)
 			if count == 0 and not kwargs['user_was_deleted']:
 				self.rollback_error(tx, ERR_PARAMETERS,
-						    ERR_PAGE_NUMBER)
-				return
+						    ERR_PAGE)
+				return False
 			if count == limit:
-				users = users[:-1]
-			self.render('users_management.html', page=page,
+				users = users[1:] if backward else users[:-1]
+			if backward:
+				has_prev = count == limit
+				has_next = True
+			else:
+				has_prev = cursor is not None
+				has_next = count == limit
+			prev_page = None
+			next_page = None
+			if users and has_prev:
+				prev_page = encode_cursor(users[0])
+			if users and has_next:
+				next_page = encode_cursor(users[-1])
+			self.render('users_management.html',
+				    page_query=page_query,
 				    **users_management_params, users=users,
-				    is_last_page=(count < limit),
+				    prev_page=prev_page, next_page=next_page,
 				    get_val=get_html_val, **kwargs,
 				    CONFIRM_DELETE=CONFIRM_DELETE)
 			yield tx.commit()
 		except:
 			logger.exception('Error during getting users')
 			self.rollback_error(tx, e_hdr=ERR_500)
-			return
+			return False
+		return True
 
 	@tornado.gen.coroutine
 	@need_rights(CAN_EDIT_USERS | CAN_SEE_USERS)
@@ -154,6 +224,7 @@ class UsersManagementHandler(BaseHandler):
 		assert(action == 'delete')
 		try:
 			yield delete_user_by_id(tx, id)
+			change = yield insert_user_change(tx, id)
 			#
 			# If the user deleted himself, then logout
 			# him by clearing all his cookies.
@@ -166,7 +237,15 @@ class UsersManagementHandler(BaseHandler):
 					 'with id: %s' % id)
 			self.rollback_error(tx, e_hdr=ERR_500)
 			return
-		yield self.render_page_and_commit(tx, **kwargs)
+		committed = yield self.render_page_and_commit(tx, **kwargs)
+		#
+		# Drop the sessions of the user. The version of the
+		# change is recorded only after the commit, else it
+		# is reused by the next change and is skipped by the
+		# poll.
+		#
+		if committed:
+			cache.changes.user_changed(change, id)
 
 	@tornado.gen.coroutine
 	@need_rights(CAN_EDIT_USERS | CAN_SEE_USERS)
@@ -236,8 +315,15 @@ class UsersManagementHandler(BaseHandler):
 			self.render_error(ERR_PARAMETERS, ERR_PASSWORD_MATCH)
 			return
 		if need_password:
-			salt, password_hash =\
-				sc.generate_password_hash(password)
+			try:
+				salt, password_hash = yield \
+					sc.generate_password_hash_async(password)
+			except ExecutorBusyError:
+				logger.error('Too many passwords are being '\
+					     'hashed')
+				self.render_error(ERR_500, 'Сервер занят, '\
+						  'повторите попытку позже')
+				return
 		#
 		# Check mask correctness.
 		#
@@ -288,14 +374,27 @@ class UsersManagementHandler(BaseHandler):
 					yield update_user(tx, id, email, None,
 							  None, name,
 							  rights_mask)
+				change = yield insert_user_change(tx, id)
 				kwargs['user_was_edited'] = True
 				#
 				# If the user edited himself, then
-				# update his cookies.
+				# update his session.
 				#
 				if id == self.current_user['user_id']:
-					self.update_cookies(rights_mask, name)
-			yield self.render_page_and_commit(tx, **kwargs)
+					user = yield self.load_user(tx, id)
+					self.set_session(user)
+			committed = yield self.render_page_and_commit(tx,
+								      **kwargs)
+			#
+			# Drop the old sessions of the user. The version
+			# of the change is recorded only after the commit.
+			# On the rollback only the local session, which
+			# could be issued above, is dropped.
+			#
+			if action == 'edit' and committed:
+				cache.changes.user_changed(change, id)
+			elif action == 'edit':
+				cache.sessions.invalidate(id)
 		except Exception as e:
 			if len(e.args) > 0 and e.args[0] == DUPLICATE_ERROR:
 				msg = 'Пользователь с таким адресом почты '\
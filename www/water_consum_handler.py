@@ -44,11 +44,9 @@ class WaterConsumHandler(BaseHandler):
 					  e_msg='Год и месяц должны быть '\
 						'положительными числами')
 			return
-		tx = None
 		try:
 			start_week, days_count =\
 				calendar.monthrange(year, month)
-			tx = yield application.begin()
 			statistics = None
 			cols = ['net_water_consum_expected_ph',
 				'net_water_consum_real_ph',
@@ -58,13 +56,13 @@ class WaterConsumHandler(BaseHandler):
 				'make_up_water_consum_real_pm']
 			try:
 				statistics =\
-					yield get_sum_reports_by_month(tx, year,
-								       month,
-								       cols)
+					yield get_sum_reports_by_month(
+						self.get_analytics_reader(),
+						year, month, cols)
 			except Exception:
 				logger.exception('Error with getting average '\
 						 'values for month reports')
-				self.rollback_error(tx, e_hdr=ERR_500)
+				self.render_error(e_hdr=ERR_500)
 				return
 			self.render('water_consum.html', month_names=month_names,
 				    month=month, year=year,
@@ -72,11 +70,8 @@ class WaterConsumHandler(BaseHandler):
 				    statistics=statistics, get_val=get_html_val,
 				    get_float=get_html_float_to_str,
 				    get_date=get_str_date)
-			tx.commit()
 		except Exception:
 			logger.exception("Error with rendering month report")
-			if tx:
-				tx.rollback()
 			self.render_error(e_hdr=ERR_500,
 					  e_msg='Ошибка при генерации страницы')
 			return
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import json
+from io import BytesIO
 import datetime
 from zipfile import BadZipFile
 import logging
@@ -10,17 +11,88 @@ logger = logging.getLogger('volgograd_log.xml_parser')
 import xlrd
 from openpyxl import load_workbook
 from openpyxl.reader.excel import load_workbook, InvalidFileException
-from openpyxl.workbook import Workbook
 from query import get_str_date
 
+##
+# Compact read-only copy of a worksheet, filled by a single pass
+# over its rows. Parsers address cells with 1-based row and column
+# numbers, the same way as openpyxl does, but without a per-cell
+# lookup in the workbook.
+#
+class SheetBuffer:
+	##
+	# @param rows Iterable of rows, each row is a sequence of cell
+	#             values.
+	#
+	def __init__(self, rows):
+		self.rows = [tuple(row) for row in rows]
+		#
+		# Read-only worksheets can report trailing empty rows, so
+		# max_row is the last row with at least one value.
+		#
+		while self.rows and all(v is None for v in self.rows[-1]):
+			self.rows.pop()
+		self.max_row = len(self.rows)
+
+	##
+	# Get a value of the cell or None, if the cell is out of the
+	# sheet bounds.
+	#
+	def value(self, row, col):
+		if row < 1 or row > self.max_row:
+			return None
+		values = self.rows[row - 1]
+		if col < 1 or col > len(values):
+			return None
+		return values[col - 1]
+
+##
+# Read all rows of the openpyxl worksheet into SheetBuffer.
+#
+def buffer_openpyxl_sheet(sheet):
+	return SheetBuffer(sheet.iter_rows(values_only=True))
+
+##
+# Sheet of a legacy xls workbook, opened by xlrd. It has the same
+# interface as SheetBuffer, so the parsers read the xlrd sheet
+# directly.
+#
+class XLRDSheet:
+	def __init__(self, sheet, datemode):
+		self.sheet = sheet
+		self.datemode = datemode
+		self.max_row = sheet.nrows
+
+	def value(self, row, col):
+		if row < 1 or row > self.max_row:
+			return None
+		if col < 1 or col > self.sheet.row_len(row - 1):
+			return None
+		cell = self.sheet.cell(row - 1, col - 1)
+		#
+		# Excel saves dates as numbers so need to carefully
+		# convert such cells in a readable representation. It
+		# is done only for the cells, which are actually read.
+		#
+		if cell.ctype == xlrd.XL_CELL_DATE:
+			value = xlrd.xldate_as_tuple(cell.value, self.datemode)
+			return get_str_date(*(value[:3]))
+		return cell.value
+
 def get_cell(a, row, col):
-	s = a.cell(row=row, column=col).value
+	s = a.value(row, col)
 	if s is None or s == '':
 		return None
 	return str(s).strip()
 
 class XLSCellError(Exception):
 	def __init__(self, row, column, real, expected):
+		#
+		# Pass the attributes to the base class to make the
+		# error picklable - it can be raised in a worker
+		# process.
+		#
+		super(XLSCellError, self).__init__(row, column, real, expected)
 		self.row = row
 		self.column = column
 		self.real = real
@@ -337,8 +409,10 @@ def parse_xls_without_forecast(a):
 	result['districts'] = ditricts
 	return result
 
-def open_xls_as_xlsx(filename):
-	# First open using xlrd.
+##
+# Find the first not empty sheet of the legacy xls workbook.
+#
+def open_xls_sheet(filename):
 	book = xlrd.open_workbook(file_contents=filename.getvalue())
 	index = 0
 	nrows, ncols = 0, 0
@@ -347,39 +421,33 @@ def open_xls_as_xlsx(filename):
 		nrows = sheet.nrows
 		ncols = sheet.ncols
 		index += 1
-
-	# prepare a xlsx sheet
-	book1 = Workbook()
-	sheet1 = book1.active
-
-	for row in range(0, nrows):
-		for col in range(0, ncols):
-			cell = sheet.cell(row, col)
-			#
-			# Excel saves dates as numbers so need to
-			# carefully convert such cells in a
-			# readable representation.
-			#
-			if cell.ctype == xlrd.XL_CELL_DATE:
-				value = xlrd.xldate_as_tuple(cell.value,
-							     book.datemode)
-				value = get_str_date(*(value[:3]))
-			else:
-				value = cell.value
-			sheet1.cell(row=row+1, column=col+1).value = value
-
-	return book1
+	return XLRDSheet(sheet, book.datemode)
 
 def parse_xls(file):
 	wb = None
 	try:
-		wb = load_workbook(filename=file, data_only=True)
+		#
+		# Read-only mode streams the sheet instead of building
+		# the whole workbook object tree in memory.
+		#
+		wb = load_workbook(filename=file, read_only=True,
+				   data_only=True)
+		try:
+			a = buffer_openpyxl_sheet(wb.active)
+		finally:
+			wb.close()
 	except BadZipFile:
 		logger.warning("Can't open xls, try to use xlrd...")
-		wb = open_xls_as_xlsx(file)
+		a = open_xls_sheet(file)
 		logger.warning('Success')
-	a = wb.active
 	if 'Сводные данные о работе котельных' in get_cell(a, 1, 2):
 		return parse_xls_without_forecast(a)
 	else:
 		return parse_xls_with_forecast(a)
+
+##
+# Parse the report from the file content. Unlike parse_xls, it takes
+# bytes, so it can be executed in a worker process.
+#
+def parse_xls_content(content):
+	return parse_xls(BytesIO(content))
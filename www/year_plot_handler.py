@@ -8,6 +8,7 @@ import tornado.web
 import tornado.gen
 
 import application
+import cache
 from query import *
 from constants import *
 from base_handler import BaseHandler, need_rights
@@ -35,23 +36,38 @@ class YearPlotHandler(BaseHandler):
 						' числом')
 			return
 		days = calendar.isleap(year) and 366 or 365
-		tx = None
-		try:
-			tx = yield application.begin()
-			boilers = yield get_boiler_room_ids_and_titles(tx)
+		#
+		# The first boiler report and the temperature do not
+		# depend on each other and are loaded concurrently.
+		#
+		@tornado.gen.coroutine
+		def get_first_report(tx):
+			boilers = yield cache.dimensions.get_boiler_room_ids_and_titles(tx)
 			column = ['all_day_expected_temp1', 'T1', 'T2' ]
 			first_id = boilers[0]['id']
-			first_report =\
-				yield get_boiler_year_report(tx, first_id,
-							     year, column)
-			year_temperature = yield get_year_temperature(tx, year)
-			self.render('year_plot.html', year=year,
-				    days_count=days, first_report=first_report,
-				    first_id=first_id, boilers=boilers,
-				    year_temperature=year_temperature)
-			tx.commit()
+			series = yield cache.year_series.load(tx, first_id, year,
+							      column)
+			first_report = {}
+			for col, values in series.items():
+				first_report[col] = cache.get_series_days(values)
+			return (boilers, first_id, first_report)
+
+		#
+		# The temperature is not cached and can be read from a
+		# replica.
+		#
+		analytics_reader = self.get_analytics_reader()
+		try:
+			first, year_temperature = yield application.run_parallel(
+				get_first_report,
+				lambda tx: get_year_temperature(analytics_reader,
+								year))
 		except:
 			logger.exception('Error with getting boiler room ids '\
 					 'and reports about first room')
-			self.rollback_error(tx, e_hdr=ERR_500)
+			self.render_error(e_hdr=ERR_500)
 			return
+		boilers, first_id, first_report = first
+		self.render('year_plot.html', year=year, days_count=days,
+			    first_report=first_report, first_id=first_id,
+			    boilers=boilers, year_temperature=year_temperature)